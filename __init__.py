@@ -137,6 +137,14 @@ def register():
 
     bpy.types.Scene.CC3ImportProps = bpy.props.PointerProperty(type=properties.CC3ImportProps)
 
+    shaders.compile_shader_matrix()
+
+    for handlers in [bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post]:
+        handlers.append(properties.clear_cache_indexes_handler)
+    bpy.app.handlers.load_post.append(properties.property_updates_load_handler)
+    for handlers in [bpy.app.handlers.undo_post, bpy.app.handlers.redo_post]:
+        handlers.append(properties.property_updates_undo_handler)
+
 def unregister():
 
     addon_updater_ops.unregister()
@@ -145,3 +153,12 @@ def unregister():
         bpy.utils.unregister_class(cls)
 
     del(bpy.types.Scene.CC3ImportProps)
+
+    for handlers in [bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post]:
+        if properties.clear_cache_indexes_handler in handlers:
+            handlers.remove(properties.clear_cache_indexes_handler)
+        for handler in [properties.property_updates_load_handler, properties.property_updates_undo_handler]:
+            if handler in handlers:
+                handlers.remove(handler)
+
+    properties.clear_property_updates()
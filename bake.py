@@ -16,8 +16,11 @@
 
 import bpy
 import os
+import math
+import hashlib
+import numpy as np
 from mathutils import Vector
-from . import nodeutils, utils, params
+from . import nodeutils, imageutils, utils, params
 
 old_samples = 64
 old_file_format = "PNG"
@@ -26,20 +29,33 @@ old_look = "None"
 old_gamma = 1
 old_exposure = 0
 old_colorspace = "Raw"
+old_compression = 15
 BAKE_SAMPLES = 4
 IMAGE_FORMAT = "PNG"
 IMAGE_EXT = ".png"
 BAKE_INDEX = 1001
+BAKE_SURFACE = None
+BAKE_QUEUE_RUNNING = False
+BAKE_CACHE_HITS = 0
+BAKE_CACHE_MISSES = 0
+NODE_BASE_PROPS = None
+TEXTURE_SIZE_CACHE = {}
+old_engine = "BLENDER_EEVEE"
+old_shading = "SOLID"
 
 
 def init_bake():
-    global BAKE_INDEX
+    global BAKE_INDEX, BAKE_CACHE_HITS, BAKE_CACHE_MISSES
     BAKE_INDEX = 1001
+    TEXTURE_SIZE_CACHE.clear()
+    BAKE_CACHE_HITS = 0
+    BAKE_CACHE_MISSES = 0
 
 
 def prep_bake():
-    global old_samples, old_file_format
+    global old_samples, old_file_format, old_compression
     global old_view_transform, old_look, old_gamma, old_exposure, old_colorspace
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
 
     old_samples = bpy.context.scene.cycles.samples
     old_file_format = bpy.context.scene.render.image_settings.file_format
@@ -48,6 +64,7 @@ def prep_bake():
     old_gamma = bpy.context.scene.view_settings.gamma
     old_exposure = bpy.context.scene.view_settings.exposure
     old_colorspace = bpy.context.scene.sequencer_colorspace_settings.name
+    old_compression = bpy.context.scene.render.image_settings.compression
 
     bpy.context.scene.cycles.samples = BAKE_SAMPLES
     bpy.context.scene.render.use_bake_multires = False
@@ -59,6 +76,8 @@ def prep_bake():
     bpy.context.scene.render.bake.margin = 16
     bpy.context.scene.render.bake.use_clear = True
     bpy.context.scene.render.image_settings.file_format = IMAGE_FORMAT
+    if prefs.bake_fast_compression:
+        bpy.context.scene.render.image_settings.compression = 10
     # color management settings affect the baked output so set them to standard/raw defaults:
     bpy.context.scene.view_settings.view_transform = 'Standard'
     bpy.context.scene.view_settings.look = 'None'
@@ -68,11 +87,12 @@ def prep_bake():
 
 
 def post_bake():
-    global old_samples, old_file_format
+    global old_samples, old_file_format, old_compression
     global old_view_transform, old_look, old_gamma, old_exposure, old_colorspace
 
     bpy.context.scene.cycles.samples = old_samples
     bpy.context.scene.render.image_settings.file_format = old_file_format
+    bpy.context.scene.render.image_settings.compression = old_compression
     bpy.context.scene.view_settings.view_transform = old_view_transform
     bpy.context.scene.view_settings.look = old_look
     bpy.context.scene.view_settings.gamma = old_gamma
@@ -80,43 +100,348 @@ def post_bake():
     bpy.context.scene.sequencer_colorspace_settings.name = old_colorspace
 
 
-def bake_socket_input(node, socket_name, mat, channel_id, bake_dir):
-    global BAKE_INDEX
+def begin_bake_session():
+    """Prepares the scene for baking: creates the bake surface and sets up the render engine and bake settings.
+       Everything is restored by end_bake_session().
+    """
+    global BAKE_SURFACE, old_engine, old_shading
 
-    # determine the size of the image to bake onto
-    width, height = get_largest_texture_to_socket(node, socket_name)
-    if width == 0:
-        width = 1024
-    if height == 0:
-        height = 1024
-
-    # determine image name and color space
-    image_name = "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_" + str(BAKE_INDEX)
-    BAKE_INDEX += 1
-    is_data = True
-    if "Diffuse Map" in socket_name:
-        is_data = False
+    if BAKE_SURFACE:
+        return
 
     # deselect everything
     bpy.ops.object.select_all(action='DESELECT')
     # create the baking plane, a single quad baking surface for an even sampling across the entire texture
     bpy.ops.mesh.primitive_plane_add(size=2, enter_editmode=False, align='WORLD', location=(0, 0, 0), scale=(1, 1, 1))
-    bake_surface = bpy.context.active_object
+    BAKE_SURFACE = bpy.context.active_object
 
     # go into wireframe mode (so Blender doesn't update or recompile the material shaders while
     # we manipulate them for baking, and also so Blender doesn't fire up the cycles viewport...):
-    shading = bpy.context.space_data.shading.type
-    bpy.context.space_data.shading.type = 'WIREFRAME'
+    space_data = bpy.context.space_data
+    if space_data and hasattr(space_data, "shading"):
+        old_shading = space_data.shading.type
+        space_data.shading.type = 'WIREFRAME'
     # set cycles rendering mode for baking
-    engine = bpy.context.scene.render.engine
+    old_engine = bpy.context.scene.render.engine
     bpy.context.scene.render.engine = 'CYCLES'
 
+    prep_bake()
+
+
+def end_bake_session():
+    global BAKE_SURFACE
+
+    if not BAKE_SURFACE:
+        return
+
+    post_bake()
+
+    # remove the bake surface and restore the render settings
+    mesh = BAKE_SURFACE.data
+    bpy.data.objects.remove(BAKE_SURFACE)
+    bpy.data.meshes.remove(mesh)
+    BAKE_SURFACE = None
+    bpy.context.scene.render.engine = old_engine
+    space_data = bpy.context.space_data
+    if space_data and hasattr(space_data, "shading"):
+        space_data.shading.type = old_shading
+
+
+def set_bake_surface_material(mat):
     # attach the material to bake to the baking surface plane
     # (the baking plane also ensures that only one material is baked onto only one target image)
-    if len(bake_surface.data.materials) == 0:
-        bake_surface.data.materials.append(mat)
+    if len(BAKE_SURFACE.data.materials) == 0:
+        BAKE_SURFACE.data.materials.append(mat)
     else:
-        bake_surface.data.materials[0] = mat
+        BAKE_SURFACE.data.materials[0] = mat
+
+
+def socket_bake_job(node, socket_name, mat, channel_id, bake_dir, scalar = False):
+    return ["SOCKET", node, socket_name, mat, channel_id, bake_dir, scalar]
+
+
+def bump_and_normal_bake_job(shader_node, bsdf_node, normal_socket_name, bump_socket_name, bump_strength_socket_name, mat, channel_id, bake_dir):
+    return ["BUMP_NORMAL", shader_node, bsdf_node, normal_socket_name, bump_socket_name, bump_strength_socket_name, mat, channel_id, bake_dir]
+
+
+def run_bake_job(job):
+    op = job[0]
+    if op == "SOCKET":
+        return bake_socket_input(*job[1:7])
+    elif op == "BUMP_NORMAL":
+        return bake_bump_and_normal(*job[1:])
+    return None
+
+
+def bake_queue(jobs):
+    """Bakes all the queued bake jobs in one bake session, with one bake surface and one set of scene
+       setup and restore. Scalar socket bakes on the same material are packed three at a time into one bake.
+       Returns the baked images (or baked image file paths) in the same order as the jobs.
+    """
+    global BAKE_QUEUE_RUNNING
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+
+    images = [None] * len(jobs)
+    if not jobs:
+        return images
+
+    utils.log_info("Baking " + str(len(jobs)) + " queued bake jobs:")
+    utils.log_indent()
+    utils.start_timer()
+
+    # the bake session is only started by the first job that actually needs to bake
+    BAKE_QUEUE_RUNNING = True
+    try:
+        # group the scalar socket bakes that still need baking by material, shader node and size
+        packs = {}
+        for i, job in enumerate(jobs):
+            if job[0] == "SOCKET" and job[6] and prefs.export_bake_packed:
+                node, socket_name, mat, channel_id, bake_dir = job[1:6]
+                image, image_name, width, height, is_data = prepare_socket_bake(node, socket_name, mat, channel_id, bake_dir)
+                if image:
+                    images[i] = image
+                else:
+                    key = (mat.name, node.name, bake_dir, width, height)
+                    if key not in packs:
+                        packs[key] = []
+                    packs[key].append([i, socket_name, image_name])
+            else:
+                images[i] = run_bake_job(job)
+
+        for key, pack in packs.items():
+            mat_name, node_name, bake_dir, width, height = key
+            for p in range(0, len(pack), 3):
+                channels = pack[p:p + 3]
+                first_job = jobs[channels[0][0]]
+                node, mat = first_job[1], first_job[3]
+                if len(channels) == 1:
+                    i, socket_name, image_name = channels[0]
+                    images[i] = bake_prepared_socket(node, socket_name, mat, image_name, width, height, True, bake_dir, True)
+                else:
+                    image_paths = bake_packed_sockets(node, [c[1] for c in channels], mat, [c[2] for c in channels],
+                                                      width, height, bake_dir)
+                    for c, image_path in zip(channels, image_paths):
+                        images[c[0]] = image_path
+    finally:
+        BAKE_QUEUE_RUNNING = False
+        end_bake_session()
+        utils.log_recess()
+
+    utils.log_timer("Bake queue", "s")
+    utils.log_info("Bake cache: " + str(BAKE_CACHE_HITS) + " hits, " + str(BAKE_CACHE_MISSES) + " misses")
+    return images
+
+
+def get_bake_cache_key(sockets, width, height, *extra):
+    """Returns a stable hash of the node subgraphs feeding the given (node, socket_name) inputs, including
+       the node types, input default values, node settings, linked image files and their modification times
+       and the bake target size. Returns None if the result can't be cached (e.g. unsaved image edits).
+    """
+
+    hasher = hashlib.sha1()
+    done = {}
+    for node, socket_name in sockets:
+        hash_update(hasher, "socket", node.bl_idname, socket_name)
+        if socket_name in node.inputs:
+            hash_socket(hasher, node.inputs[socket_name], done)
+    hash_update(hasher, "target", width, height, *extra)
+
+    if "uncacheable" in done:
+        return None
+    return hasher.hexdigest()
+
+
+def hash_update(hasher, *values):
+    hasher.update(repr(values).encode("utf-8"))
+
+
+def hash_socket(hasher, socket, done):
+    if socket.is_linked:
+        for link in socket.links:
+            hash_update(hasher, "link", link.from_node.name, link.from_socket.identifier)
+            hash_node(hasher, link.from_node, done)
+    elif hasattr(socket, "default_value"):
+        hash_update(hasher, "value", get_hash_value(socket.default_value, done))
+
+
+def hash_node(hasher, node, done):
+    global NODE_BASE_PROPS
+
+    pointer = node.as_pointer()
+    if pointer in done:
+        return
+    done[pointer] = True
+
+    if NODE_BASE_PROPS is None:
+        NODE_BASE_PROPS = set(prop.identifier for prop in bpy.types.Node.bl_rna.properties)
+
+    hash_update(hasher, "node", node.name, node.bl_idname)
+
+    # node specific settings (math operation, blend type, image, color ramp...)
+    for prop in node.bl_rna.properties:
+        if prop.identifier not in NODE_BASE_PROPS and prop.identifier != "node_tree":
+            hash_update(hasher, prop.identifier, get_hash_value(getattr(node, prop.identifier), done))
+
+    for socket in node.inputs:
+        hash_update(hasher, "input", socket.identifier)
+        hash_socket(hasher, socket, done)
+
+    # node groups: hash the group node tree from the group outputs
+    if node.type == "GROUP" and node.node_tree:
+        hash_update(hasher, "group", node.node_tree.name)
+        for group_node in node.node_tree.nodes:
+            if group_node.type == "GROUP_OUTPUT":
+                hash_node(hasher, group_node, done)
+
+
+def get_hash_value(value, done, depth = 0):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    if isinstance(value, bpy.types.Image):
+        if value.is_dirty:
+            done["uncacheable"] = True
+        image_path = bpy.path.abspath(value.filepath)
+        mtime = None
+        if os.path.exists(image_path):
+            mtime = os.path.getmtime(image_path)
+        packed_size = value.packed_file.size if value.packed_file else 0
+        generated = None
+        if value.source == "GENERATED":
+            generated = (value.generated_type, tuple(value.generated_color), value.use_generated_float)
+        return (value.name, get_library_path(value), value.source, image_path, mtime, packed_size,
+                tuple(value.size), value.colorspace_settings.name, generated)
+
+    if isinstance(value, bpy.types.Object):
+        # texture coordinate / attribute nodes using an object depend on its placement
+        return (value.name, get_library_path(value), tuple(tuple(row) for row in value.matrix_world))
+
+    if isinstance(value, bpy.types.ID):
+        return (value.name, get_library_path(value), type(value).__name__)
+
+    if isinstance(value, bpy.types.ColorRamp):
+        return (value.interpolation, value.color_mode,
+                tuple((e.position, tuple(e.color)) for e in value.elements))
+
+    if isinstance(value, bpy.types.CurveMapping):
+        return tuple(tuple((tuple(p.location), p.handle_type) for p in curve.points) for curve in value.curves)
+
+    if isinstance(value, bpy.types.bpy_struct):
+        # nested settings structs (image user, texture mapping, color mapping...): hash their properties
+        if depth >= 2:
+            return type(value).__name__
+        struct_values = [type(value).__name__]
+        for prop in value.bl_rna.properties:
+            if prop.identifier != "rna_type":
+                struct_values.append((prop.identifier, get_hash_value(getattr(value, prop.identifier, None), done, depth + 1)))
+        return tuple(struct_values)
+
+    if isinstance(value, bpy.types.bpy_prop_collection):
+        return tuple(get_hash_value(item, done, depth + 1) for item in value)
+
+    try:
+        # vectors, colors and arrays
+        return tuple(value)
+    except:
+        return str(value)
+
+
+def get_library_path(id):
+    if id.library:
+        return bpy.path.abspath(id.library.filepath)
+    return ""
+
+
+def get_cached_bake(mat, channel_id, bake_dir, cache_key):
+    """Returns the image name and the cached baked image (or None) for the bake cache key.
+    """
+    global BAKE_CACHE_HITS, BAKE_CACHE_MISSES
+
+    image_name = "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_" + cache_key[:16]
+    image_path = os.path.join(utils.local_path(), bake_dir, image_name + IMAGE_EXT)
+    prune_cached_bakes(os.path.dirname(image_path), "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_", image_name)
+
+    if os.path.exists(image_path):
+        BAKE_CACHE_HITS += 1
+        utils.log_info("Using cached bake: " + image_name)
+        return image_name, imageutils.load_image(image_path, "Non-Color")
+
+    BAKE_CACHE_MISSES += 1
+    return image_name, None
+
+
+def prune_cached_bakes(dir, prefix, keep_name):
+    """Removes the cached bakes of the same material channel with a different cache key,
+       as they were baked from an older version of the material nodes and can't be used again.
+    """
+
+    if not os.path.isdir(dir):
+        return
+
+    for file in os.listdir(dir):
+        name, ext = os.path.splitext(file)
+        if ext.lower() == IMAGE_EXT and name.startswith(prefix) and name != keep_name:
+            key = name[len(prefix):]
+            if len(key) == 16 and all(c in "0123456789abcdef" for c in key):
+                try:
+                    utils.log_info("Removing stale cached bake: " + file)
+                    os.remove(os.path.join(dir, file))
+                except Exception as e:
+                    utils.log_warn("Unable to remove stale cached bake: " + file + " " + str(e))
+
+
+def prepare_socket_bake(node, socket_name, mat, channel_id, bake_dir):
+    """Works out the target size, color space and image name for a socket bake.
+       Returns [image, image_name, width, height, is_data], where image is already the result
+       if no bake is needed (constant node chains and cached bakes).
+    """
+    global BAKE_INDEX
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+
+    # determine color space
+    is_data = True
+    if "Diffuse Map" in socket_name:
+        is_data = False
+
+    # sockets driven only by constant nodes don't need baking, just a small constant color texture:
+    constant_color = get_constant_socket_color(node, socket_name)
+    if constant_color is not None:
+        return [make_constant_image(mat, channel_id, bake_dir, is_data, constant_color), None, 4, 4, is_data]
+
+    # determine the size of the image to bake onto
+    width, height = get_largest_texture_to_socket(node, socket_name)
+    if width == 0:
+        width = 1024
+    if height == 0:
+        height = 1024
+
+    # determine the image name and look for a cached bake of the same nodes
+    if prefs.export_bake_cache:
+        cache_key = get_bake_cache_key([(node, socket_name)], width, height, "SOCKET", is_data)
+        if cache_key:
+            image_name, image = get_cached_bake(mat, channel_id, bake_dir, cache_key)
+            if image and not is_data:
+                image.colorspace_settings.name = "sRGB"
+            return [image, image_name, width, height, is_data]
+
+    image_name = "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_" + str(BAKE_INDEX)
+    BAKE_INDEX += 1
+    return [None, image_name, width, height, is_data]
+
+
+def bake_socket_input(node, socket_name, mat, channel_id, bake_dir, scalar = False):
+    image, image_name, width, height, is_data = prepare_socket_bake(node, socket_name, mat, channel_id, bake_dir)
+    if image:
+        return image
+    return bake_prepared_socket(node, socket_name, mat, image_name, width, height, is_data, bake_dir, scalar)
+
+
+def bake_prepared_socket(node, socket_name, mat, image_name, width, height, is_data, bake_dir, scalar = False):
+
+    # set up the bake surface and render settings, unless already part of a bake session (queue)
+    own_session = not BAKE_QUEUE_RUNNING
+    begin_bake_session()
+    set_bake_surface_material(mat)
 
     # get the node and output socket to bake from
     nodes = mat.node_tree.nodes
@@ -127,22 +452,71 @@ def bake_socket_input(node, socket_name, mat, channel_id, bake_dir):
     image = get_image_target(image_name, width, height, bake_dir, is_data, True)
 
     # bake the source node output onto the target image and re-save it
-    image_node = bake_output(mat, source_node, source_socket, image, image_name)
+    image_node = bake_output(mat, source_node, source_socket, image, image_name, True, scalar)
 
     # reconnect the custom nodes to the shader socket
     nodes.remove(image_node)
     nodeutils.link_nodes(mat.node_tree.links, source_node, source_socket, node, socket_name)
 
-    # remove the bake surface and restore the render settings
-    bpy.data.objects.remove(bake_surface)
-    bpy.context.scene.render.engine = engine
-    bpy.context.space_data.shading.type = shading
+    if own_session:
+        end_bake_session()
 
     return image
 
 
+def bake_packed_sockets(node, socket_names, mat, image_names, width, height, bake_dir):
+    """Bakes up to three scalar sockets in one pass, packed into the R, G and B channels of one image,
+       then splits the channels into separate grayscale PNG files. Returns the file paths.
+    """
+    global BAKE_INDEX
+
+    own_session = not BAKE_QUEUE_RUNNING
+    begin_bake_session()
+    set_bake_surface_material(mat)
+
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+
+    # route each socket source into a channel of a combine RGB node
+    combine_node = nodes.new("ShaderNodeCombineRGB")
+    for i, socket_name in enumerate(socket_names):
+        source_node, source_socket = nodeutils.get_node_and_socket_connected_to_input(node, socket_name)
+        nodeutils.link_nodes(links, source_node, source_socket, combine_node, i)
+
+    # the packed image is only needed in memory
+    packed_name = "EXPORT_BAKE_" + mat.name + "_Packed_" + str(BAKE_INDEX)
+    BAKE_INDEX += 1
+    packed_image = bpy.data.images.new(packed_name, width, height, alpha = True, is_data = True)
+
+    image_node = bake_output(mat, combine_node, "Image", packed_image, packed_name, False)
+    nodes.remove(image_node)
+    nodes.remove(combine_node)
+
+    if own_session:
+        end_bake_session()
+
+    # split the channels into grayscale images
+    pixels = np.empty(width * height * 4, dtype = np.float32)
+    packed_image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(packed_image)
+    pixels = pixels.reshape(height, width, 4)[::-1]
+
+    level = imageutils.get_png_compression_level()
+    dir = os.path.join(utils.local_path(), bake_dir)
+    image_paths = []
+    for i, image_name in enumerate(image_names):
+        channel = (np.clip(pixels[:, :, i], 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+        image_path = os.path.normpath(os.path.join(dir, image_name + IMAGE_EXT))
+        imageutils.submit_png_write(image_path, channel[:, :, np.newaxis], level)
+        image_paths.append(image_path)
+        utils.log_info("Unpacked channel: " + image_name)
+
+    return image_paths
+
+
 def bake_bump_and_normal(shader_node, bsdf_node, normal_socket_name, bump_socket_name, bump_strength_socket_name, mat, channel_id, bake_dir):
     global BAKE_INDEX
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
 
     # determine the size of the image to bake onto
     width, height = get_largest_texture_to_socket(shader_node, normal_socket_name)
@@ -156,31 +530,26 @@ def bake_bump_and_normal(shader_node, bsdf_node, normal_socket_name, bump_socket
     if height == 0:
         height = 1024
 
-    # determine image name and color space
-    image_name = "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_" + str(BAKE_INDEX)
-    BAKE_INDEX += 1
+    # determine color space
     is_data = True
 
-    # deselect everything
-    bpy.ops.object.select_all(action='DESELECT')
-    # create the baking plane, a single quad baking surface for an even sampling across the entire texture
-    bpy.ops.mesh.primitive_plane_add(size=2, enter_editmode=False, align='WORLD', location=(0, 0, 0))
-    bake_surface = bpy.context.active_object
-
-    # go into wireframe mode (so Blender doesn't update or recompile the material shaders while
-    # we manipulate them for baking, and also so Blender doesn't fire up the cycles viewport...):
-    shading = bpy.context.space_data.shading.type
-    bpy.context.space_data.shading.type = 'WIREFRAME'
-    # set cycles rendering mode for baking
-    engine = bpy.context.scene.render.engine
-    bpy.context.scene.render.engine = 'CYCLES'
-
-    # attach the material to bake to the baking surface plane
-    # (the baking plane also ensures that only one material is baked onto only one target image)
-    if len(bake_surface.data.materials) == 0:
-        bake_surface.data.materials.append(mat)
-    else:
-        bake_surface.data.materials[0] = mat
+    # determine the image name and look for a cached bake of the same nodes
+    image_name = None
+    if prefs.export_bake_cache:
+        cache_key = get_bake_cache_key([(shader_node, normal_socket_name), (shader_node, bump_socket_name),
+                                        (shader_node, bump_strength_socket_name)], width, height, "BUMP_NORMAL")
+        if cache_key:
+            image_name, image = get_cached_bake(mat, channel_id, bake_dir, cache_key)
+            if image:
+                return image
+    if not image_name:
+        image_name = "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_" + str(BAKE_INDEX)
+        BAKE_INDEX += 1
+
+    # set up the bake surface and render settings, unless already part of a bake session (queue)
+    own_session = not BAKE_QUEUE_RUNNING
+    begin_bake_session()
+    set_bake_surface_material(mat)
 
     # get the node and output socket to bake from
     nodes = mat.node_tree.nodes
@@ -196,8 +565,8 @@ def bake_bump_and_normal(shader_node, bsdf_node, normal_socket_name, bump_socket
     nodeutils.link_nodes(links, bump_source_node, bump_source_socket, bump_map_node, "Height")
     nodeutils.link_nodes(links, bump_map_node, "Normal", bsdf_node, "Normal")
 
-    # make (and save) the target image
-    image = get_image_target(image_name, width, height, bake_dir, is_data, True)
+    # make (and save) the target image (normals bake in full float precision)
+    image = get_image_target(image_name, width, height, bake_dir, is_data, True, True)
 
     # bake the source node output onto the target image and re-save it
     image_node = bake_bsdf_normal(mat, bsdf_node, image, image_name)
@@ -208,15 +577,13 @@ def bake_bump_and_normal(shader_node, bsdf_node, normal_socket_name, bump_socket
     nodes.remove(image_node)
     nodeutils.link_nodes(links, bsdf_normal_node, bsdf_normal_socket, bsdf_node, "Normal")
 
-    # remove the bake surface and restore the render settings
-    bpy.data.objects.remove(bake_surface)
-    bpy.context.scene.render.engine = engine
-    bpy.context.space_data.shading.type = shading
+    if own_session:
+        end_bake_session()
 
     return image
 
 
-def bake_output(mat, source_node, source_socket, image, image_name):
+def bake_output(mat, source_node, source_socket, image, image_name, save = True, scalar = False):
     nodes = mat.node_tree.nodes
     links = mat.node_tree.links
 
@@ -226,20 +593,17 @@ def bake_output(mat, source_node, source_socket, image, image_name):
     image_node = nodeutils.make_image_node(nodes, image, "bake")
     image_node.name = image_name
 
-    bpy.context.scene.cycles.samples = BAKE_SAMPLES
     utils.log_info("Baking: " + image_name)
 
-    prep_bake()
-
     nodeutils.link_nodes(links, source_node, source_socket, output_node, "Surface")
     image_node.select = True
     nodes.active = image_node
     bpy.ops.object.bake(type='COMBINED')
 
-    image.save_render(filepath = image.filepath, scene = bpy.context.scene)
-    image.reload()
-
-    post_bake()
+    # write the baked image in the background, or save it now if it can't be
+    if save and not imageutils.save_image_async(image, scalar = scalar):
+        image.save_render(filepath = image.filepath, scene = bpy.context.scene)
+        image.reload()
 
     if output_source:
         nodeutils.link_nodes(links, output_source, output_source_socket, output_node, "Surface")
@@ -256,65 +620,314 @@ def bake_bsdf_normal(mat, bsdf_node, image, image_name):
     image_node = nodeutils.make_image_node(nodes, image, "bake")
     image_node.name = image_name
 
-    bpy.context.scene.cycles.samples = BAKE_SAMPLES
     utils.log_info("Baking normal: " + image_name)
 
-    prep_bake()
-
     nodeutils.link_nodes(links, bsdf_node, "BSDF", output_node, "Surface")
     image_node.select = True
     nodes.active = image_node
 
     bpy.ops.object.bake(type='NORMAL')
 
-    image.save_render(filepath = image.filepath, scene = bpy.context.scene)
-    image.reload()
-
-    post_bake()
+    # write the baked image in the background, or save it now if it can't be
+    if not imageutils.save_image_async(image):
+        image.save_render(filepath = image.filepath, scene = bpy.context.scene)
+        image.reload()
 
     return image_node
 
 
-def get_largest_texture_to_node(node, done):
+def get_constant_socket_color(node, socket_name):
+    """Evaluates the color that would be baked from the node connected to the socket, if everything feeding it
+       is constant (value, RGB, math and mix nodes). Returns the RGBA color or None if it can't be evaluated.
+    """
+
+    source_node, source_socket = nodeutils.get_node_and_socket_connected_to_input(node, socket_name)
+    if source_node is None:
+        return None
+
+    try:
+        value = evaluate_node_output(source_node, source_node.outputs[source_socket], [])
+    except:
+        value = None
+
+    if value is None:
+        return None
+    return constant_to_color(value)
+
+
+def evaluate_socket_input(socket, path):
+    if socket.is_linked:
+        link = socket.links[0]
+        if link.is_muted:
+            return None
+        return evaluate_node_output(link.from_node, link.from_socket, path)
+    elif hasattr(socket, "default_value"):
+        value = socket.default_value
+        if isinstance(value, float):
+            return value
+        return tuple(value)
+    return None
+
+
+def evaluate_node_output(node, socket, path):
+    # guard against cycles
+    if node in path or node.mute:
+        return None
+    path = path + [node]
+
+    if node.type == "VALUE" or node.type == "RGB":
+        return constant_from_socket(socket)
+
+    elif node.type == "REROUTE":
+        return evaluate_socket_input(node.inputs[0], path)
+
+    elif node.type == "MATH":
+        a = constant_to_float(evaluate_socket_input(node.inputs[0], path))
+        b = constant_to_float(evaluate_socket_input(node.inputs[1], path))
+        c = 0.0
+        if len(node.inputs) > 2:
+            c = constant_to_float(evaluate_socket_input(node.inputs[2], path))
+        if a is None or b is None or c is None:
+            return None
+        value = evaluate_math(node.operation, a, b, c)
+        if value is not None and node.use_clamp:
+            value = utils.clamp(value)
+        return value
+
+    elif node.type == "MIX_RGB":
+        fac = constant_to_float(evaluate_socket_input(node.inputs["Fac"], path))
+        c1 = constant_to_color(evaluate_socket_input(node.inputs["Color1"], path))
+        c2 = constant_to_color(evaluate_socket_input(node.inputs["Color2"], path))
+        if fac is None or c1 is None or c2 is None:
+            return None
+        fac = utils.clamp(fac)
+        rgb = [ evaluate_mix(node.blend_type, fac, c1[i], c2[i]) for i in range(0, 3) ]
+        if None in rgb:
+            return None
+        if node.use_clamp:
+            rgb = [ utils.clamp(x) for x in rgb ]
+        return (rgb[0], rgb[1], rgb[2], c1[3])
+
+    return None
+
+
+def constant_from_socket(socket):
+    value = socket.default_value
+    if isinstance(value, float):
+        return value
+    return tuple(value)
+
+
+def constant_to_float(value):
+    if value is None or isinstance(value, float):
+        return value
+    if len(value) == 3:
+        return (value[0] + value[1] + value[2]) / 3.0
+    # color to float conversion uses the luminance
+    return value[0] * 0.2126 + value[1] * 0.7152 + value[2] * 0.0722
+
+
+def constant_to_color(value):
+    if value is None:
+        return None
+    if isinstance(value, float):
+        return (value, value, value, 1.0)
+    if len(value) == 3:
+        return (value[0], value[1], value[2], 1.0)
+    return tuple(value)
+
+
+def evaluate_math(op, a, b, c):
+    if op == "ADD":
+        return a + b
+    elif op == "SUBTRACT":
+        return a - b
+    elif op == "MULTIPLY":
+        return a * b
+    elif op == "DIVIDE":
+        return a / b if b != 0.0 else 0.0
+    elif op == "MULTIPLY_ADD":
+        return a * b + c
+    elif op == "POWER":
+        if a >= 0.0 or float(b).is_integer():
+            try:
+                return float(pow(a, b))
+            except:
+                return 0.0
+        return 0.0
+    elif op == "MINIMUM":
+        return min(a, b)
+    elif op == "MAXIMUM":
+        return max(a, b)
+    elif op == "LESS_THAN":
+        return 1.0 if a < b else 0.0
+    elif op == "GREATER_THAN":
+        return 1.0 if a > b else 0.0
+    elif op == "ABSOLUTE":
+        return abs(a)
+    elif op == "SQRT":
+        return math.sqrt(a) if a > 0.0 else 0.0
+    elif op == "INVERSE_SQRT":
+        return 1.0 / math.sqrt(a) if a > 0.0 else 0.0
+    elif op == "ROUND":
+        return math.floor(a + 0.5)
+    elif op == "FLOOR":
+        return float(math.floor(a))
+    elif op == "CEIL":
+        return float(math.ceil(a))
+    elif op == "FRACT":
+        return a - math.floor(a)
+    elif op == "MODULO":
+        return math.fmod(a, b) if b != 0.0 else 0.0
+    elif op == "SIGN":
+        return math.copysign(1.0, a) if a != 0.0 else 0.0
+    return None
+
+
+def evaluate_mix(blend_type, fac, c1, c2):
+    if blend_type == "MIX":
+        return c1 * (1.0 - fac) + c2 * fac
+    elif blend_type == "ADD":
+        return c1 + c2 * fac
+    elif blend_type == "SUBTRACT":
+        return c1 - c2 * fac
+    elif blend_type == "MULTIPLY":
+        return c1 * (1.0 - fac + fac * c2)
+    elif blend_type == "SCREEN":
+        return 1.0 - (1.0 - fac + fac * (1.0 - c2)) * (1.0 - c1)
+    elif blend_type == "DIVIDE":
+        return c1 * (1.0 - fac) + fac * c1 / c2 if c2 != 0.0 else c1
+    elif blend_type == "DIFFERENCE":
+        return c1 * (1.0 - fac) + fac * abs(c1 - c2)
+    elif blend_type == "DARKEN":
+        return c1 * (1.0 - fac) + fac * min(c1, c2)
+    elif blend_type == "LIGHTEN":
+        return max(c1, c2 * fac)
+    return None
+
+
+def make_constant_image(mat, channel_id, bake_dir, is_data, color):
+    """Writes a constant color into a small 4 x 4 texture in place of baking it.
+    """
+    global BAKE_INDEX
+
+    image_name = "EXPORT_BAKE_" + mat.name + "_" + channel_id + "_" + str(BAKE_INDEX)
+    BAKE_INDEX += 1
+    utils.log_info("Constant bake: " + image_name + " = " + str(tuple(round(c, 4) for c in color)))
+
+    # baking writes color textures in sRGB space, so do the same
+    if not is_data:
+        color = utils.linear_to_srgb(color)
+    color = [ utils.clamp(c) for c in color[:3] ] + [1.0]
+
+    image = get_image_target(image_name, 4, 4, bake_dir, is_data, True)
+    image.pixels.foreach_set(np.tile(np.array(color, dtype = np.float32), 16))
+    image.update()
+    if not imageutils.save_image_async(image):
+        image.save()
+    return image
+
+
+def get_largest_texture_to_node(node):
+    """Returns the largest texture size feeding into any of the node inputs.
+    """
     largest_width = 0
     largest_height = 0
-    socket : bpy.types.NodeSocket
-    for socket in node.inputs:
-        if socket.is_linked:
-            width, height = get_largest_texture_to_socket(node, socket.name, done)
-            if width > largest_width:
-                largest_width = width
-            if height > largest_height:
-                largest_height = height
+    for upstream_node in get_upstream_nodes(node):
+        width, height = get_largest_texture_from_node(upstream_node)
+        largest_width = max(width, largest_width)
+        largest_height = max(height, largest_height)
     return largest_width, largest_height
 
 
-def get_largest_texture_to_socket(node, socket, done = None):
-    if done is None:
-        done = []
-
+def get_largest_texture_to_socket(node, socket):
     connected_node = nodeutils.get_node_connected_to_input(node, socket)
-    if connected_node is None or connected_node in done:
+    if connected_node is None:
         return 0, 0
+    return get_largest_texture_from_node(connected_node)
+
+
+def get_largest_texture_from_node(node):
+    """Returns the largest texture size that reaches the node (or the size of the image if an image node).
+       Sizes are resolved once per node, upstream nodes first, and cached until the next init_bake().
+    """
+
+    key = get_node_key(node)
+    if key in TEXTURE_SIZE_CACHE:
+        return TEXTURE_SIZE_CACHE[key]
+
+    # depth first walk upstream, resolving each node after everything upstream of it
+    stack = [(node, False)]
+    visiting = set()
+    while stack:
+        next_node, upstream_done = stack.pop()
+        next_key = get_node_key(next_node)
+        if next_key in TEXTURE_SIZE_CACHE:
+            continue
+        if upstream_done:
+            visiting.discard(next_key)
+            TEXTURE_SIZE_CACHE[next_key] = resolve_texture_size(next_node)
+        elif next_key not in visiting:
+            visiting.add(next_key)
+            stack.append((next_node, True))
+            for upstream_node in get_upstream_nodes(next_node):
+                upstream_key = get_node_key(upstream_node)
+                # (nodes already being visited are part of a cycle and are skipped)
+                if upstream_key not in TEXTURE_SIZE_CACHE and upstream_key not in visiting:
+                    stack.append((upstream_node, False))
+
+    return TEXTURE_SIZE_CACHE[key]
+
+
+def resolve_texture_size(node):
+    if node.type == "TEX_IMAGE":
+        return get_tex_image_size(node)
 
-    done.append(connected_node)
+    largest_width = 0
+    largest_height = 0
+    for upstream_node in get_upstream_nodes(node):
+        width, height = TEXTURE_SIZE_CACHE.get(get_node_key(upstream_node), (0, 0))
+        largest_width = max(width, largest_width)
+        largest_height = max(height, largest_height)
+    return largest_width, largest_height
 
-    if connected_node.type == "TEX_IMAGE":
-        return get_tex_image_size(connected_node)
-    else:
-        return get_largest_texture_to_node(connected_node, done)
+
+def get_upstream_nodes(node):
+    """Returns the nodes connected to the node inputs and, for group nodes, the group output node inside the group.
+    """
+    upstream_nodes = []
+    if node.type == "TEX_IMAGE":
+        return upstream_nodes
+
+    for socket in node.inputs:
+        if socket.is_linked:
+            upstream_nodes.append(socket.links[0].from_node)
+
+    if node.type == "GROUP" and node.node_tree:
+        for group_node in node.node_tree.nodes:
+            if group_node.type == "GROUP_OUTPUT":
+                upstream_nodes.append(group_node)
+
+    return upstream_nodes
+
+
+def get_node_key(node):
+    # node names are unique within a node tree (and, unlike node pointers, are not reused by new nodes)
+    return (node.id_data.as_pointer(), node.name)
 
 
 def get_tex_image_size(node):
-    if node is not None:
+    if node is not None and node.image is not None:
         return node.image.size[0], node.image.size[1]
     return 0, 0
 
 
-def get_image_target(image_name, width, height, dir, data = True, alpha = False):
+def get_image_target(image_name, width, height, dir, data = True, alpha = False, precise = False):
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
     format = IMAGE_FORMAT
     ext = IMAGE_EXT
-    depth = 32
+    float_buffer = precise or not prefs.bake_byte_buffers
+    depth = 128 if float_buffer else 32
 
     # find an old image with the same name to reuse:
     for img in bpy.data.images:
@@ -343,18 +956,19 @@ def get_image_target(image_name, width, height, dir, data = True, alpha = False)
 
     # or just make a new one:
     utils.log_info("Creating new image: " + image_name + " size: " + str(width))
-    img = make_new_image(image_name, width, height, format, ext, dir, data, alpha)
+    img = make_new_image(image_name, width, height, format, ext, dir, data, alpha, precise)
     return img
 
 
-def make_new_image(name, width, height, format, ext, dir, data, has_alpha):
-    img = bpy.data.images.new(name, width, height, alpha=has_alpha, is_data=data)
+def make_new_image(name, width, height, format, ext, dir, data, has_alpha, precise = False):
+    img = imageutils.new_image(name, width, height, has_alpha, data, precise)
     img.pixels[0] = 0
     img.file_format = format
     dir = os.path.join(utils.local_path(), dir)
     os.makedirs(dir, exist_ok=True)
     img.filepath_raw = os.path.join(dir, name + ext)
-    img.save()
+    if not imageutils.save_image_async(img):
+        img.save()
     return img
 
 
@@ -413,7 +1027,81 @@ def bake_flow_to_normal(mat_cache):
         convert_flow_to_normal(flow_image, normal_image, tangent, flip_y)
 
 
-def convert_flow_to_normal(flow_image: bpy.types.Image, normal_image: bpy.types.Image, tangent, flip_y):
+def convert_flow_to_normal(flow_image: bpy.types.Image, normal_image: bpy.types.Image, tangent, flip_y, tile_rows = None):
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+
+    width = flow_image.size[0]
+    height = flow_image.size[1]
+
+    if tile_rows is None:
+        tile_rows = prefs.flow_normal_tile_size
+
+    memory_start = utils.memory_mb()
+
+    # read all the flow pixels in one go into a flat float buffer:
+    pixels = np.empty(width * height * 4, dtype = np.float32)
+    flow_image.pixels.foreach_get(pixels)
+
+    # convert them to normal pixels in place:
+    if tile_rows > 0 and height > tile_rows:
+        convert_flow_to_normal_tiled(pixels.reshape(-1, 4), width, height, tangent, flip_y, tile_rows)
+    else:
+        flow_to_normal_pixels(pixels.reshape(-1, 4), tangent, flip_y, pixels.reshape(-1, 4))
+
+    # and write them all back in one go:
+    normal_image.pixels.foreach_set(pixels)
+    memory_used = utils.memory_mb() - memory_start
+    pixels = None
+    normal_image.update()
+    # the normal map stays in the character's materials, so it must be saved (and switched to its file) now
+    imageutils.save_image(normal_image)
+
+    utils.log_info("Flow map converted: " + str(width) + " x " + str(height) +
+                   ", memory used: " + str(int(memory_used)) + " MB")
+
+
+def convert_flow_to_normal_tiled(pixels, width, height, tangent, flip_y, tile_rows):
+    """Converts an (N, 4) buffer of flow map pixels into normal map pixels in place, in bands of tile_rows rows,
+       so the temporary arrays of the conversion are bounded by the band size rather than the image size.
+       (Blender image pixels can only be read and written whole, any slice of image.pixels copies the entire image,
+       so the image itself is always read and written in one go.)
+    """
+
+    utils.log_info("Converting flow map in bands of " + str(tile_rows) + " rows")
+
+    for row in range(0, height, tile_rows):
+        num_rows = min(tile_rows, height - row)
+        band = pixels[row * width:(row + num_rows) * width]
+        flow_to_normal_pixels(band, tangent, flip_y, band)
+
+
+def flow_to_normal_pixels(flow_pixels, tangent, flip_y, normal_pixels = None):
+    """Converts an (N, 4) array of flow map pixels into an (N, 4) array of normal map pixels.
+    """
+
+    if normal_pixels is None:
+        normal_pixels = np.empty_like(flow_pixels)
+
+    # rgb -> flow_vector
+    flow_vectors = flow_pixels[:, :3] * 2.0 - 1.0
+    if flip_y:
+        flow_vectors[:, 1] *= -1.0
+
+    # calculate normal vector (zero length normals stay zero, as with Vector.normalized())
+    normal_vectors = np.cross(np.asarray(tangent, dtype = np.float32), flow_vectors)
+    lengths = np.sqrt(np.einsum("ij,ij->i", normal_vectors, normal_vectors))[:, np.newaxis]
+    np.divide(normal_vectors, lengths, out = normal_vectors, where = lengths > 0)
+
+    # normal_vector -> rgb
+    normal_pixels[:, :3] = (normal_vectors + 1.0) * 0.5
+    normal_pixels[:, 3] = 1.0
+
+    return normal_pixels
+
+
+def convert_flow_to_normal_per_pixel(flow_image: bpy.types.Image, normal_image: bpy.types.Image, tangent, flip_y):
+    """Per pixel reference implementation of convert_flow_to_normal(), kept for comparison in the benchmarks.
+    """
 
     # fetching a copy of the normal pixels as a list gives us the fastest write speed:
     normal_pixels = list(normal_image.pixels)
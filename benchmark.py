@@ -0,0 +1,398 @@
+# Copyright (C) 2021 Victor Soupday
+# This file is part of CC3_Blender_Tools <https://github.com/soupday/cc3_blender_tools>
+#
+# CC3_Blender_Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CC3_Blender_Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Performance benchmarks for the add-on. Not registered with the add-on, run it with:
+
+    blender -b --python benchmark.py -- [results.json]
+
+Results are printed and written to the json file (default: cc3_benchmark.json in the current directory).
+"""
+
+import os
+import sys
+import copy
+import math
+import json
+import time
+import datetime
+import tempfile
+import importlib
+import tracemalloc
+
+import bpy
+import numpy as np
+
+if __package__:
+    from . import bake, exporter, imageutils, meshutils, nodeutils, params, properties, shaders, vars
+
+
+FLOW_SIZES = [1024, 2048, 4096]
+BAKE_SIZES = [512, 1024, 2048]
+BAKE_SOCKETS = ["Diffuse Map", "AO Map", "Metallic Map", "Roughness Map", "Normal Map", "Bump Map"]
+VERTEX_GROUP_VERTICES = 500000
+LOOKUP_CHARACTERS = 20
+
+
+def make_test_image(name, size, dir, data = True):
+    image = bpy.data.images.new(name, size, size, alpha = True, is_data = data)
+    pixels = np.random.default_rng(size).random(size * size * 4, dtype = np.float32)
+    image.pixels.foreach_set(pixels)
+    image.file_format = "PNG"
+    image.filepath_raw = os.path.join(dir, name + ".png")
+    image.save()
+    return image
+
+
+def time_function(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    # include any background image writes in the time
+    imageutils.wait_for_image_writes()
+    return time.perf_counter() - start
+
+
+def peak_allocation_mb(func, *args):
+    """Returns the peak memory allocated by python and numpy while running the function, in MB.
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        imageutils.wait_for_image_writes()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_flow_to_normal(sizes = FLOW_SIZES, dir = None):
+    """Times the numpy flow map to normal map conversion against the per pixel implementation.
+    """
+
+    if dir is None:
+        dir = tempfile.mkdtemp()
+
+    tangent = (1, 0, 0)
+    results = []
+
+    for size in sizes:
+        flow_image = make_test_image("BENCH_Flow_" + str(size), size, dir)
+        normal_image = make_test_image("BENCH_Normal_" + str(size), size, dir)
+
+        vectorized = time_function(bake.convert_flow_to_normal, flow_image, normal_image, tangent, True, 0)
+        tiled = time_function(bake.convert_flow_to_normal, flow_image, normal_image, tangent, True, 256)
+        per_pixel = time_function(bake.convert_flow_to_normal_per_pixel, flow_image, normal_image, tangent, True)
+        vectorized_mb = peak_allocation_mb(bake.convert_flow_to_normal, flow_image, normal_image, tangent, True, 0)
+        tiled_mb = peak_allocation_mb(bake.convert_flow_to_normal, flow_image, normal_image, tangent, True, 256)
+
+        result = { "name": "flow_to_normal", "size": size,
+                   "vectorized": vectorized, "tiled": tiled, "per_pixel": per_pixel,
+                   "vectorized_peak_mb": vectorized_mb, "tiled_peak_mb": tiled_mb,
+                   "speedup": per_pixel / max(vectorized, 0.000001) }
+        print("flow_to_normal " + str(size) + "x" + str(size) +
+              ": vectorized " + "{:.3f}".format(vectorized) + "s" +
+              ", tiled " + "{:.3f}".format(tiled) + "s" +
+              ", per pixel " + "{:.3f}".format(per_pixel) + "s" +
+              ", peak allocation " + "{:.0f}".format(vectorized_mb) + "MB / tiled " + "{:.0f}".format(tiled_mb) + "MB" +
+              ", speedup x" + "{:.1f}".format(result["speedup"]))
+        results.append(result)
+
+        bpy.data.images.remove(flow_image)
+        bpy.data.images.remove(normal_image)
+
+    return results
+
+
+def make_bench_character(name, dir):
+    props = bpy.context.scene.CC3ImportProps
+
+    chr_cache = props.import_cache.add()
+    chr_cache.import_name = name
+    chr_cache.import_dir = dir
+    bpy.ops.mesh.primitive_plane_add(size=2, enter_editmode=False, align='WORLD', location=(0, 0, 0))
+    obj = bpy.context.active_object
+    obj.name = name
+    chr_cache.add_object_cache(obj)
+    return chr_cache, obj
+
+
+def remove_bench_data(props, first_cache, objects = [], materials = []):
+    """Removes the benchmark objects, materials, images and character caches (from first_cache on),
+       so repeated runs in the same session start from the same scene.
+    """
+
+    for obj in objects:
+        if obj:
+            mesh = obj.data
+            bpy.data.objects.remove(obj)
+            if mesh and mesh.users == 0:
+                bpy.data.meshes.remove(mesh)
+    for mat in materials:
+        if mat:
+            bpy.data.materials.remove(mat)
+    for image in [ image for image in bpy.data.images if image.name.startswith("BENCH_") or
+                                                          image.name.startswith("EXPORT_BAKE_BENCH_") ]:
+        bpy.data.images.remove(image)
+    while len(props.import_cache) > first_cache:
+        props.import_cache.remove(len(props.import_cache) - 1)
+    properties.clear_cache_indexes()
+
+
+def make_bench_material(chr_cache, obj, name, size, dir):
+    """Builds a Pbr material with the add-on shader setup and procedural nodes (noise mixed with a
+       size x size image) connected to the texture sockets, so that every socket needs baking.
+    """
+
+    mat = bpy.data.materials.new(name)
+    mat.use_nodes = True
+    obj.data.materials.append(mat)
+    mat_cache = chr_cache.add_material_cache(mat, "DEFAULT")
+    mat_cache.dir = dir
+    shaders.fetch_prop_defaults(mat_cache, None)
+    shaders.connect_pbr_shader(obj, mat, None)
+
+    bsdf_node, shader_node, mix_node = nodeutils.get_shader_nodes(mat, "rl_pbr_shader")
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+
+    image = bpy.data.images.new(name + "_Detail", size, size)
+    image_node = nodeutils.make_image_node(nodes, image, "bench_detail")
+    for i, socket_name in enumerate(BAKE_SOCKETS):
+        noise_node = nodes.new("ShaderNodeTexNoise")
+        noise_node.inputs["Scale"].default_value = 5.0 + i
+        mix_node = nodeutils.make_mixrgb_node(nodes, "MULTIPLY")
+        nodeutils.link_nodes(links, noise_node, "Color", mix_node, "Color1")
+        nodeutils.link_nodes(links, image_node, "Color", mix_node, "Color2")
+        nodeutils.link_nodes(links, mix_node, "Color", shader_node, socket_name)
+
+    return mat, mat_cache, shader_node, bsdf_node
+
+
+def benchmark_bakes(sizes = BAKE_SIZES, dir = None, materials = 4):
+    """Times single socket bakes, bump and normal bakes and a full write_back_textures pass
+       (queued bakes of all the sockets of several materials) at each size.
+    """
+
+    if dir is None:
+        dir = tempfile.mkdtemp()
+    bake_dir = os.path.join(dir, "Bake")
+
+    props = bpy.context.scene.CC3ImportProps
+    results = []
+    for size in sizes:
+        first = len(props.import_cache)
+        obj = None
+        mats = []
+        try:
+            chr_cache, obj = make_bench_character("BENCH_" + str(size), dir)
+            for m in range(0, materials):
+                mats.append(make_bench_material(chr_cache, obj, "BENCH_" + str(size) + "_" + str(m), size, dir))
+            results.extend(benchmark_bake_size(mats, size, dir, bake_dir, materials))
+        finally:
+            imageutils.wait_for_image_writes()
+            remove_bench_data(props, first, [obj], [m[0] for m in mats])
+
+    return results
+
+
+def benchmark_bake_size(mats, size, dir, bake_dir, materials):
+    """Times the bakes of the benchmark materials at one size.
+    """
+
+    results = []
+    mat, mat_cache, shader_node, bsdf_node = mats[0]
+
+    bake.init_bake()
+    socket_time = time_function(bake.bake_socket_input, shader_node, "Roughness Map", mat, "Roughness", bake_dir)
+    bump_normal_time = time_function(bake.bake_bump_and_normal, shader_node, bsdf_node, "Normal Map", "Bump Map",
+                                     "Bump Strength", mat, "Normal", bake_dir)
+
+    def write_back_all():
+        bake.init_bake()
+        bake_jobs = []
+        for mat, mat_cache, shader_node, bsdf_node in mats:
+            mat_json = copy.deepcopy(params.JSON_PBR_MATERIAL)
+            exporter.write_back_textures(mat_json, mat, mat_cache, dir, bake_jobs)
+        bake.bake_queue([job[0] for job in bake_jobs])
+
+    write_back_time = time_function(write_back_all)
+
+    for name, duration in [["bake_socket_input", socket_time],
+                           ["bake_bump_and_normal", bump_normal_time],
+                           ["write_back_textures", write_back_time]]:
+        result = { "name": name, "size": size, "time": duration }
+        if name == "write_back_textures":
+            result["materials"] = materials
+        print(name + " " + str(size) + "x" + str(size) + ": " + "{:.3f}".format(duration) + "s")
+        results.append(result)
+
+    return results
+
+
+def legacy_clear_vertex_group(obj, vertex_group):
+    all_verts = []
+    for v in obj.data.vertices:
+        all_verts.append(v.index)
+    vertex_group.remove(all_verts)
+
+
+def legacy_set_vertex_group(obj, vertex_group, value):
+    all_verts = []
+    for v in obj.data.vertices:
+        all_verts.append(v.index)
+    vertex_group.add(all_verts, value, 'ADD')
+
+
+def benchmark_vertex_groups(vertices = VERTEX_GROUP_VERTICES):
+    """Times the bulk vertex group fill and clear against per vertex python loops.
+    """
+
+    side = int(math.sqrt(vertices))
+    bpy.ops.mesh.primitive_grid_add(x_subdivisions = side, y_subdivisions = side, size = 2)
+    obj = bpy.context.active_object
+    obj.name = "BENCH_Vertex_Groups"
+    num_verts = len(obj.data.vertices)
+    group = obj.vertex_groups.new(name = "BENCH_Group")
+
+    results = []
+    try:
+        for name, bulk, legacy in [
+                ["vertex_group_fill", [meshutils.set_vertex_group, obj, group, 0.5], [legacy_set_vertex_group, obj, group, 0.5]],
+                ["vertex_group_clear", [meshutils.clear_vertex_group, obj, group], [legacy_clear_vertex_group, obj, group]]]:
+            bulk_time = time_function(*bulk)
+            # the legacy clear needs something to clear
+            if name == "vertex_group_clear":
+                meshutils.set_vertex_group(obj, group, 0.5)
+            legacy_time = time_function(*legacy)
+            result = { "name": name, "vertices": num_verts,
+                       "bulk": bulk_time, "per_vertex": legacy_time,
+                       "speedup": legacy_time / max(bulk_time, 0.000001) }
+            print(name + " " + str(num_verts) + " verts" +
+                  ": bulk " + "{:.3f}".format(bulk_time) + "s" +
+                  ", per vertex " + "{:.3f}".format(legacy_time) + "s" +
+                  ", speedup x" + "{:.1f}".format(result["speedup"]))
+            results.append(result)
+    finally:
+        mesh = obj.data
+        bpy.data.objects.remove(obj)
+        bpy.data.meshes.remove(mesh)
+    return results
+
+
+def legacy_get_character_cache(props, obj, mat):
+    if obj:
+        for chr_cache in props.import_cache:
+            for obj_cache in chr_cache.object_cache:
+                if obj_cache.object == obj:
+                    return chr_cache
+    if mat:
+        for chr_cache in props.import_cache:
+            for collection_name in properties.MATERIAL_CACHE_COLLECTIONS:
+                for mat_cache in getattr(chr_cache, collection_name):
+                    if mat_cache.material == mat:
+                        return chr_cache
+    return None
+
+
+def benchmark_character_lookup(characters = LOOKUP_CHARACTERS, objects = 20, materials = 40, repeats = 5):
+    """Times the object and material -> character cache lookups, with a number of synthetic characters
+       in the import cache, against scanning every character's object and material caches.
+    """
+
+    props = bpy.context.scene.CC3ImportProps
+    first = len(props.import_cache)
+    lookups = []
+    try:
+        for c in range(0, characters):
+            chr_cache = props.import_cache.add()
+            chr_cache.import_name = "BENCH_Character_" + str(c)
+            for o in range(0, objects):
+                name = chr_cache.import_name + "_" + str(o)
+                obj = bpy.data.objects.new(name, bpy.data.meshes.new(name))
+                chr_cache.add_object_cache(obj)
+                lookups.append([obj, None])
+            for m in range(0, materials):
+                mat = bpy.data.materials.new(chr_cache.import_name + "_" + str(m))
+                chr_cache.add_material_cache(mat, "DEFAULT")
+                lookups.append([None, mat])
+
+        def lookup_indexed():
+            for i in range(0, repeats):
+                for obj, mat in lookups:
+                    props.get_character_cache(obj, mat)
+
+        def lookup_legacy():
+            for i in range(0, repeats):
+                for obj, mat in lookups:
+                    legacy_get_character_cache(props, obj, mat)
+
+        properties.clear_cache_indexes()
+        indexed_time = time_function(lookup_indexed)
+        legacy_time = time_function(lookup_legacy)
+        result = { "name": "character_lookup", "characters": characters, "lookups": len(lookups) * repeats,
+                   "indexed": indexed_time, "scan": legacy_time,
+                   "speedup": legacy_time / max(indexed_time, 0.000001) }
+        print("character_lookup " + str(characters) + " characters, " + str(result["lookups"]) + " lookups" +
+              ": indexed " + "{:.3f}".format(indexed_time) + "s" +
+              ", scan " + "{:.3f}".format(legacy_time) + "s" +
+              ", speedup x" + "{:.1f}".format(result["speedup"]))
+
+    finally:
+        remove_bench_data(props, first, [obj for obj, mat in lookups], [mat for obj, mat in lookups])
+
+    return [result]
+
+
+def run(output_path = None):
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+
+    # bake everything every time, on the cpu
+    old_prefs = [prefs.export_bake_nodes, prefs.export_bake_bump_to_normal, prefs.export_bake_cache]
+    prefs.export_bake_nodes = True
+    prefs.export_bake_bump_to_normal = True
+    prefs.export_bake_cache = False
+    bpy.context.scene.render.engine = "CYCLES"
+    bpy.context.scene.cycles.device = "CPU"
+
+    results = []
+    try:
+        results.extend(benchmark_flow_to_normal())
+        results.extend(benchmark_vertex_groups())
+        results.extend(benchmark_character_lookup())
+        results.extend(benchmark_bakes())
+    finally:
+        prefs.export_bake_nodes, prefs.export_bake_bump_to_normal, prefs.export_bake_cache = old_prefs
+
+    if output_path is None:
+        output_path = os.path.join(os.getcwd(), "cc3_benchmark.json")
+    report = { "blender": bpy.app.version_string,
+               "addon": vars.VERSION_STRING,
+               "date": datetime.datetime.now().isoformat(timespec = "seconds"),
+               "results": results }
+    with open(output_path, "w") as file:
+        json.dump(report, file, indent = 4)
+    print("Benchmark results written to: " + output_path)
+
+    return results
+
+
+if __name__ == "__main__":
+    # when run as a script, enable the add-on package this file belongs to and run the benchmarks from there
+    addon_dir = os.path.dirname(os.path.realpath(__file__))
+    package = os.path.basename(addon_dir)
+    sys.path.append(os.path.dirname(addon_dir))
+    import addon_utils
+    addon_utils.enable(package, default_set = True)
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    importlib.import_module(package + ".benchmark").run(argv[0] if argv else None)
@@ -338,6 +338,30 @@ def transfer_skin_weights(chr_cache, objects):
     utils.try_select_objects(selected)
 
 
+def freeze_character_modifiers(chr_cache):
+    count = 0
+    for obj_cache in chr_cache.object_cache:
+        if modifiers.freeze_eye_modifiers(obj_cache.object):
+            count += 1
+    utils.log_info("Froze eye modifiers on " + str(count) + " objects.")
+
+
+def thaw_character_modifiers(chr_cache):
+    count = 0
+    for obj_cache in chr_cache.object_cache:
+        if modifiers.thaw_eye_modifiers(obj_cache.object):
+            count += 1
+    utils.log_info("Restored eye modifiers on " + str(count) + " objects.")
+
+
+def character_modifiers_frozen(chr_cache):
+    if chr_cache:
+        for obj_cache in chr_cache.object_cache:
+            if modifiers.is_frozen(obj_cache.object):
+                return True
+    return False
+
+
 class CC3OperatorCharacter(bpy.types.Operator):
     """CC3 Character Functions"""
     bl_idname = "cc3.character"
@@ -373,6 +397,14 @@ class CC3OperatorCharacter(bpy.types.Operator):
             objects = bpy.context.selected_objects
             transfer_skin_weights(chr_cache, objects)
 
+        elif self.param == "FREEZE_MODIFIERS":
+            chr_cache = props.get_context_character_cache(context)
+            freeze_character_modifiers(chr_cache)
+
+        elif self.param == "THAW_MODIFIERS":
+            chr_cache = props.get_context_character_cache(context)
+            thaw_character_modifiers(chr_cache)
+
         return {"FINISHED"}
 
     @classmethod
@@ -386,4 +418,8 @@ class CC3OperatorCharacter(bpy.types.Operator):
             return "Remove any objects from the character data that are no longer part of the character and remove any materials from the character that are no longer in the character objects"
         elif properties.param == "TRANSFER_WEIGHTS":
             return "Transfer skin weights from the character body to the selected objects"
+        elif properties.param == "FREEZE_MODIFIERS":
+            return "Bake the eye, eye occlusion and tearline displacement modifiers into shape keys and uv layers and disable the modifiers, so they are not evaluated on every frame of playback and rendering. Parameter changes to these will not show until restored"
+        elif properties.param == "THAW_MODIFIERS":
+            return "Remove the frozen eye, eye occlusion and tearline displacement and re-enable the modifiers"
         return ""
@@ -19,7 +19,7 @@ import shutil
 
 import bpy
 
-from . import bake, shaders, nodeutils, jsonutils, utils, params
+from . import bake, shaders, nodeutils, imageutils, jsonutils, utils, params
 
 UNPACK_INDEX = 1001
 
@@ -34,6 +34,8 @@ def prep_export(chr_cache, new_name, objects, json_data, old_path, new_path):
         old_path = utils.local_path("//")
 
     changes = []
+    bake_jobs = []
+    bake.init_bake()
 
     if new_name != chr_cache.import_name:
         # rename the object and character keys
@@ -116,7 +118,7 @@ def prep_export(chr_cache, new_name, objects, json_data, old_path, new_path):
                         if prefs.export_json_changes:
                             write_back_json(mat_json, mat, mat_cache)
                         if prefs.export_texture_changes:
-                            write_back_textures(mat_json, mat, mat_cache, old_path)
+                            write_back_textures(mat_json, mat, mat_cache, old_path, bake_jobs)
                     # replace duplicate materials with a reference to a single source material
                     # (this is to ensure there are no duplicate suffixes in the fbx export)
                     if mat_count[mat_source_name] > 1:
@@ -153,6 +155,21 @@ def prep_export(chr_cache, new_name, objects, json_data, old_path, new_path):
                         bone.roll = 0
                         utils.set_mode("OBJECT")
 
+    # bake all the queued custom node bakes in one go and point their texture paths to the baked images
+    if bake_jobs:
+        images = bake.bake_queue([job[0] for job in bake_jobs])
+        for job, image in zip(bake_jobs, images):
+            if image:
+                mat, tex_id, tex_info = job[1:]
+                # (packed bakes are split straight into image files)
+                if type(image) is str:
+                    image_path = image
+                else:
+                    image_path = bpy.path.abspath(image.filepath)
+                tex_info["Texture Path"] = os.path.normpath(utils.relpath(image_path, old_path))
+                remap_texture_path(tex_info, old_path, new_path)
+                utils.log_info(mat.name + "/" + tex_id + ": Using baked texture path: " + tex_info["Texture Path"])
+
     # as the baking system can deselect everything, reselect the export objects here.
     utils.try_select_objects(objects, True)
     return changes
@@ -189,9 +206,8 @@ def restore_export(export_changes : list):
 
 
 def get_prop_value(mat_cache, prop_name, default):
-    parameters = mat_cache.parameters
     try:
-        return eval("parameters." + prop_name, None, locals())
+        return getattr(mat_cache.parameters, prop_name)
     except:
         return default
 
@@ -222,7 +238,11 @@ def write_back_json(mat_json, mat, mat_cache):
                 jsonutils.set_material_json_var(mat_json, json_var, json_value)
 
 
-def write_back_textures(mat_json : dict, mat, mat_cache, old_path):
+def write_back_textures(mat_json : dict, mat, mat_cache, old_path, bake_jobs = None):
+    """Writes the material texture paths back into the material json data.
+       If a bake_jobs list is given, any bakes are added to the list as [bake_job, mat, tex_id, tex_info]
+       to be baked later in a single bake session, otherwise they are baked immediately.
+    """
     global UNPACK_INDEX
     prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
 
@@ -232,7 +252,6 @@ def write_back_textures(mat_json : dict, mat, mat_cache, old_path):
     has_custom_shader = "Custom Shader" in mat_json.keys()
     unpack_path = os.path.join(old_path, "Unpack")
     bake_path = os.path.join(old_path, "Bake")
-    bake.init_bake()
     UNPACK_INDEX = 1001
 
     # determine if we are combining bump maps into normal maps:
@@ -283,9 +302,10 @@ def write_back_textures(mat_json : dict, mat, mat_cache, old_path):
                     if tex_node:
 
                         image : bpy.types.Image = None
+                        bake_job = None
                         if tex_node.type == "TEX_IMAGE":
                             if prefs.export_bake_nodes and tex_type == "NORMAL" and bump_combining:
-                                image = bake.bake_bump_and_normal(shader_node, bsdf_node, shader_socket, bump_socket, "Bump Strength", mat, tex_id, bake_path)
+                                bake_job = bake.bump_and_normal_bake_job(shader_node, bsdf_node, shader_socket, bump_socket, "Bump Strength", mat, tex_id, bake_path)
                             else:
                                 image = tex_node.image
 
@@ -293,9 +313,16 @@ def write_back_textures(mat_json : dict, mat, mat_cache, old_path):
                             # if something is connected to the shader socket but is not a texture image
                             # and baking is enabled: then bake the socket input into a texture for exporting:
                             if tex_type == "NORMAL" and bump_combining:
-                                image = bake.bake_bump_and_normal(shader_node, bsdf_node, shader_socket, bump_socket, "Bump Strength", mat, tex_id, bake_path)
+                                bake_job = bake.bump_and_normal_bake_job(shader_node, bsdf_node, shader_socket, bump_socket, "Bump Strength", mat, tex_id, bake_path)
                             else:
-                                image = bake.bake_socket_input(shader_node, shader_socket, mat, tex_id, bake_path)
+                                bake_job = bake.socket_bake_job(shader_node, shader_socket, mat, tex_id, bake_path,
+                                                                tex_type in params.SCALAR_TEXTURE_TYPES)
+
+                        if bake_job:
+                            if bake_jobs is not None:
+                                bake_jobs.append([bake_job, mat, tex_id, tex_info])
+                            else:
+                                image = bake.run_bake_job(bake_job)
 
                         if image:
                             try_unpack_image(image, unpack_path, True)
@@ -492,6 +519,9 @@ class CC3Export(bpy.types.Operator):
                     except Exception as e:
                         utils.log_error("Unable to copy keyfile: " + old_key_path + " to: " + new_key_path, e)
 
+                # the baked textures are written in the background during the fbx export, make sure they are all done
+                imageutils.wait_for_image_writes()
+
                 utils.log_info("Writing Json Data.")
 
                 if json_data:
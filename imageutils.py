@@ -15,11 +15,20 @@
 # along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import zlib
+import struct
+import concurrent.futures
 
 import bpy
+import numpy as np
 
 from . import params, utils
 
+IMAGE_WRITER = None
+IMAGE_WRITES = {}
+# file path key -> name of the image to switch over to its written file when the writes are done
+IMAGE_RELOADS = {}
+
 
 def check_max_size(image):
     prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
@@ -195,3 +204,184 @@ def get_material_tex_dir(character_cache, obj, mat):
 def get_material_tex_dirs(character_cache, obj, mat):
     mat_dir = get_material_tex_dir(character_cache, obj, mat)
     return [character_cache.import_main_tex_dir, mat_dir]
+
+
+def get_image_writer():
+    global IMAGE_WRITER
+    if IMAGE_WRITER is None:
+        workers = max(1, min(4, (os.cpu_count() or 2) - 1))
+        IMAGE_WRITER = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "CC3ImageWriter")
+    return IMAGE_WRITER
+
+
+def new_image(name, width, height, alpha = False, is_data = False, precise = False):
+    """Creates a new generated image. Unless precise is set (or the '8-bit bake images' preference is off)
+       the image is created with an 8-bit byte buffer instead of a 32-bit float buffer.
+    """
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+
+    float_buffer = precise or not prefs.bake_byte_buffers
+    image = bpy.data.images.new(name, width, height, alpha = alpha, is_data = is_data, float_buffer = float_buffer)
+    return image
+
+
+def save_image_async(image : bpy.types.Image, fast = None, scalar = False):
+    """Copies the pixels out of the image and encodes and writes them as a PNG to the image file path
+       on a worker thread. Only 8-bit PNG images can be written this way, for anything else this returns
+       False and the image should be saved normally. Call wait_for_image_writes() to finish all the writes,
+       which also switches the images over to their written files (as image.save() would).
+       Scalar images are written as single channel (grayscale) PNGs.
+    """
+
+    if image.is_float or image.file_format != "PNG" or not image.filepath_raw:
+        return False
+
+    level = get_png_compression_level(fast)
+
+    width = image.size[0]
+    height = image.size[1]
+    file_path = os.path.normpath(bpy.path.abspath(image.filepath_raw))
+    pixels = get_image_bytes(image, scalar)
+    submit_png_write(file_path, pixels, level)
+    IMAGE_RELOADS[os.path.normcase(file_path)] = image.name
+    return True
+
+
+def save_image(image : bpy.types.Image):
+    """Saves the image now, after finishing (or cancelling) any background write queued for the same file,
+       so the older background write can't overwrite it.
+    """
+
+    if image.filepath_raw:
+        key = os.path.normcase(os.path.normpath(bpy.path.abspath(image.filepath_raw)))
+        previous = IMAGE_WRITES.pop(key, None)
+        if previous and not previous.cancel():
+            try:
+                previous.result()
+            except Exception as e:
+                utils.log_error("Unable to write image: " + key, e)
+        IMAGE_RELOADS.pop(key, None)
+    image.save()
+
+
+def get_image_bytes(image : bpy.types.Image, scalar = False):
+    """Returns the pixels of a byte buffer image as a top row first (height, width, channels) uint8 array.
+    """
+
+    width = image.size[0]
+    height = image.size[1]
+    channels = 4 if image.depth == 32 else 3
+
+    # byte images return their stored values (already in the image color space) so they can be written as is
+    pixels = np.empty(width * height * 4, dtype = np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, 4)
+    if scalar:
+        pixels = pixels[:, :, :1]
+    # blender images are stored bottom row first
+    return (np.clip(pixels[::-1, :, :channels], 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def save_image_grayscale(image : bpy.types.Image):
+    """Saves a byte buffer image as a single channel PNG and switches it over to the saved image file.
+       Falls back to a normal save if the image can't be written that way.
+    """
+
+    if image.is_float or image.file_format != "PNG" or not image.filepath_raw:
+        image.save()
+        return
+
+    file_path = os.path.normpath(bpy.path.abspath(image.filepath_raw))
+    try:
+        write_png(file_path, get_image_bytes(image, True), get_png_compression_level())
+        image.source = "FILE"
+        image.reload()
+    except Exception as e:
+        utils.log_error("Unable to write grayscale image: " + file_path, e)
+        image.save()
+
+
+def get_png_compression_level(fast = None):
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+
+    if fast is None:
+        fast = prefs.bake_fast_compression
+    return 1 if fast else 6
+
+
+def submit_png_write(file_path, pixels, level):
+    """Queues the (height, width, channels) uint8 pixels to be written as a PNG on the image writer thread.
+    """
+
+    key = os.path.normcase(file_path)
+    # never have two writes to the same file running at once
+    if key in IMAGE_WRITES:
+        previous = IMAGE_WRITES[key]
+        if not previous.cancel():
+            previous.result()
+
+    IMAGE_WRITES[key] = get_image_writer().submit(write_png, file_path, pixels, level)
+
+
+def wait_for_image_writes():
+    """Waits for all the background image writes to finish, then switches the written images
+       from generated images over to their image files, so the pixels persist with the blend file.
+       Must be called from the main thread.
+    """
+    global IMAGE_WRITES, IMAGE_RELOADS
+
+    if not IMAGE_WRITES:
+        return
+
+    utils.log_info("Waiting for " + str(len(IMAGE_WRITES)) + " image writes to finish.")
+    for key, future in IMAGE_WRITES.items():
+        try:
+            future.result()
+        except concurrent.futures.CancelledError:
+            pass
+        except Exception as e:
+            utils.log_error("Unable to write image: " + key, e)
+            IMAGE_RELOADS.pop(key, None)
+    IMAGE_WRITES = {}
+
+    for key, image_name in IMAGE_RELOADS.items():
+        image = bpy.data.images.get(image_name)
+        if image and os.path.normcase(os.path.normpath(bpy.path.abspath(image.filepath_raw))) == key:
+            try:
+                if image.source == "GENERATED":
+                    image.source = "FILE"
+                image.reload()
+            except Exception as e:
+                utils.log_error("Unable to reload image: " + image_name, e)
+    IMAGE_RELOADS = {}
+
+
+def write_png(file_path, pixels, level = 6):
+    """Encodes and writes (height, width, channels) uint8 pixels as an 8-bit PNG.
+       Runs on the image writer threads so must not touch any Blender data.
+    """
+
+    height, width, channels = pixels.shape
+    color_type = { 1: 0, 2: 4, 3: 2, 4: 6 }[channels]
+
+    # each row starts with a filter type byte: use the 'Up' filter (difference from the previous row)
+    rows = np.ascontiguousarray(pixels).reshape(height, width * channels)
+    data = np.empty((height, width * channels + 1), dtype = np.uint8)
+    data[:, 0] = 2
+    data[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out = data[1:, 1:])
+
+    def chunk(tag, chunk_data):
+        return (struct.pack(">I", len(chunk_data)) + tag + chunk_data +
+                struct.pack(">I", zlib.crc32(tag + chunk_data) & 0xFFFFFFFF))
+
+    png = (b"\x89PNG\r\n\x1a\n" +
+           chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)) +
+           chunk(b"IDAT", zlib.compress(data.tobytes(), level)) +
+           chunk(b"IEND", b""))
+
+    os.makedirs(os.path.dirname(file_path), exist_ok = True)
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(png)
+    os.replace(temp_path, file_path)
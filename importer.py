@@ -61,6 +61,7 @@ def delete_import(chr_cache):
     chr_cache.object_cache.clear()
 
     utils.remove_from_collection(props.import_cache, chr_cache)
+    properties.clear_cache_indexes()
 
     utils.clean_collection(bpy.data.images)
     utils.clean_collection(bpy.data.materials)
@@ -85,6 +86,9 @@ def process_material(chr_cache, obj, mat, object_json):
     if not mat.use_nodes:
         mat.use_nodes = True
 
+    # the rebuilt nodes no longer match the last applied parameters
+    properties.invalidate_parameter_snapshot(mat)
+
     if chr_cache.setup_mode == "ADVANCED":
 
         if mat_cache.is_cornea() or mat_cache.is_eye():
@@ -338,6 +342,7 @@ def detect_character(file_path, type, objects, json_data, warn):
 
     chr_json = jsonutils.get_character_json(json_data, name, name)
     chr_cache = props.import_cache.add()
+    properties.clear_cache_indexes()
     chr_cache.import_file = file_path
     chr_cache.import_type = type
     chr_cache.import_name = name
@@ -17,6 +17,7 @@
 import os
 
 import bpy
+import numpy as np
 
 from . import imageutils, jsonutils, nodeutils, utils
 
@@ -659,37 +660,38 @@ def reconstruct_obj_materials(obj):
     mesh.materials.append(mat_leye)
     mesh.materials.append(mat_rcornea)
     mesh.materials.append(mat_lcornea)
-    ul = mesh.uv_layers[0]
-    # figure out which polygon belongs to which material from the vertex groups and uv coords
-    for poly in mesh.polygons:
-        loop_index = poly.loop_indices[0]
-        loop_entry = mesh.loops[loop_index]
-        vertex = mesh.vertices[loop_entry.vertex_index]
-        group = vertex.groups[0].group
-        uv = ul.data[loop_entry.index].uv
-        x = uv[0]
-        if x > 5:
-            poly.material_index = 5 # eyelash
-        elif x > 4:
-            poly.material_index = 4 # nails
-        elif x > 3:
-            poly.material_index = 3 # legs
-        elif x > 2:
-            poly.material_index = 2 # arms
-        elif x > 1:
-            poly.material_index = 1 # body
-        else:
-            # head/eyes/tongue/teeth - determine from vertex group
-            if group == 0: # tongue
-                poly.material_index = 8
-            elif group == 1: # body (head)
-                poly.material_index = 0
-            elif group == 2: # eye
-                # can't easily differentiate between the eye parts, set all to right cornea
-                poly.material_index = 11
-            elif group == 3: # teeth
-                # same with the teeth, set both to upper teeth
-                poly.material_index = 6
+    # figure out which polygon belongs to which material from the vertex groups and uv coords of the first loop
+    num_polys = len(mesh.polygons)
+    loop_start = np.empty(num_polys, dtype = np.int32)
+    material_index = np.empty(num_polys, dtype = np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    mesh.polygons.foreach_get("material_index", material_index)
+    num_loops = len(mesh.loops)
+    loop_vertex = np.empty(num_loops, dtype = np.int32)
+    loop_uv = np.empty(num_loops * 2, dtype = np.float32)
+    mesh.loops.foreach_get("vertex_index", loop_vertex)
+    mesh.uv_layers[0].data.foreach_get("uv", loop_uv)
+    x = loop_uv[loop_start * 2]
+    # head/eyes/tongue/teeth - determine from the first vertex group of the first vertex
+    # (there is no bulk access to the vertex groups, so only read them once for each head vertex)
+    head = ~(x > 1)
+    head_verts, head_inverse = np.unique(loop_vertex[loop_start[head]], return_inverse = True)
+    vertices = mesh.vertices
+    head_groups = np.array([ vertices[v].groups[0].group if len(vertices[v].groups) > 0 else -1
+                             for v in head_verts.tolist() ], dtype = np.int32)[head_inverse]
+    head_index = np.select([head_groups == 0,   # tongue
+                            head_groups == 1,   # body (head)
+                            head_groups == 2,   # eye: can't easily differentiate between the eye parts, set all to right cornea
+                            head_groups == 3],  # teeth: same with the teeth, set both to upper teeth
+                           [8, 0, 11, 6], material_index[head])
+    material_index = np.select([x > 5,  # eyelash
+                                x > 4,  # nails
+                                x > 3,  # legs
+                                x > 2,  # arms
+                                x > 1], # body
+                               [5, 4, 3, 2, 1], material_index)
+    material_index[head] = head_index
+    mesh.polygons.foreach_set("material_index", material_index)
 
 
 def set_materials_setting(param, obj, context, objects_processed):
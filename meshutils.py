@@ -14,9 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
 
-import math
+import hashlib
 
 import bpy
+import numpy as np
 
 from . import materials, utils, vars
 
@@ -30,22 +31,215 @@ def add_vertex_group(obj, name):
         return obj.vertex_groups[name]
 
 
+def get_all_vertices(obj):
+    return np.arange(len(obj.data.vertices), dtype = np.int32).tolist()
+
+
 def clear_vertex_group(obj, vertex_group):
-    all_verts = []
-    for v in obj.data.vertices:
-        all_verts.append(v.index)
-    vertex_group.remove(all_verts)
+    """Removes every vertex from the group.
+    """
+
+    vertex_group.remove(get_all_vertices(obj))
+
+
+def set_vertex_group(obj, vertex_group, value, mode = 'ADD'):
+    """Fills the group with every vertex of the mesh at the weight value.
+    """
+
+    vertex_group.add(get_all_vertices(obj), value, mode)
+
+
+# weights are written in steps of 1/WEIGHT_STEPS, so that vertices can be added in batches of equal weight
+WEIGHT_STEPS = 4096
+
+
+def set_vertex_group_weights(vertex_group, verts, weights):
+    """Replaces the weights of the vertices in the group, with one add() call per distinct (quantized) weight.
+    """
+
+    if len(verts) == 0:
+        return
+    steps = np.round(np.clip(weights, 0.0, 1.0) * WEIGHT_STEPS).astype(np.int32)
+    order = np.argsort(steps, kind = "stable")
+    steps = steps[order]
+    verts = verts[order]
+    starts = np.flatnonzero(np.diff(steps, prepend = -1))
+    ends = np.append(starts[1:], len(steps))
+    for start, end in zip(starts, ends):
+        vertex_group.add(verts[start:end].tolist(), float(steps[start]) / WEIGHT_STEPS, 'REPLACE')
+
+
+def get_mesh_loop_data(mesh):
+    """Bulk reads the loops of the mesh in polygon order.
+       Returns the vertex index, uv (first uv layer) and polygon material index of each loop.
+    """
+
+    num_polys = len(mesh.polygons)
+    loop_start = np.empty(num_polys, dtype = np.int32)
+    loop_total = np.empty(num_polys, dtype = np.int32)
+    poly_material = np.empty(num_polys, dtype = np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    mesh.polygons.foreach_get("loop_total", loop_total)
+    mesh.polygons.foreach_get("material_index", poly_material)
+
+    num_loops = len(mesh.loops)
+    loop_vertex = np.empty(num_loops, dtype = np.int32)
+    loop_uv = np.empty(num_loops * 2, dtype = np.float32)
+    mesh.loops.foreach_get("vertex_index", loop_vertex)
+    if len(mesh.uv_layers) > 0:
+        mesh.uv_layers[0].data.foreach_get("uv", loop_uv)
+    else:
+        loop_uv.fill(0.0)
+    loop_uv = loop_uv.reshape(-1, 2)
+
+    # loop indices in the order the polygons visit them
+    poly_offset = np.repeat(np.cumsum(loop_total) - loop_total, loop_total)
+    order = np.repeat(loop_start, loop_total) + np.arange(len(poly_offset)) - poly_offset
+
+    return loop_vertex[order], loop_uv[order], np.repeat(poly_material, loop_total)
+
+
+def get_material_slot_mask(obj, loop_material, material, exclude = None):
+    """Returns a mask of the loops whose polygon material slot holds the material.
+    """
+
+    slots = [ i for i, slot in enumerate(obj.material_slots)
+              if slot.material == material and not (exclude and slot.material == exclude) ]
+    return np.isin(loop_material, slots)
+
+
+def get_last_loop_per_vertex(loop_vertex, mask):
+    """For the loops in the mask, returns each vertex once along with the last loop that visits it,
+       i.e. the loop whose values a per loop REPLACE would have left in the vertex group.
+    """
+
+    loops = np.flatnonzero(mask)[::-1]
+    verts, first = np.unique(loop_vertex[loops], return_index = True)
+    return verts, loops[first]
+
+
+def get_material_name(mat):
+    return mat.name if mat else ""
+
+
+def get_mesh_fingerprint(obj):
+    """A cheap fingerprint of the mesh topology and material slots, to invalidate the per mesh caches with.
+       Includes a hash of the loop vertex indices and the polygon sizes and material indices (bulk read),
+       so reassigned face materials and edits that keep the same element counts still change it.
+    """
+
+    mesh = obj.data
+    loop_vertex = np.empty(len(mesh.loops), dtype = np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertex)
+    poly_total = np.empty(len(mesh.polygons), dtype = np.int32)
+    mesh.polygons.foreach_get("loop_total", poly_total)
+    poly_material = np.empty(len(mesh.polygons), dtype = np.int32)
+    mesh.polygons.foreach_get("material_index", poly_material)
+    topology = hashlib.sha1(loop_vertex.tobytes())
+    topology.update(poly_total.tobytes())
+    topology.update(poly_material.tobytes())
+    return (len(mesh.vertices), len(mesh.loops), len(mesh.polygons), topology.hexdigest(),
+            tuple(slot.material.name if slot.material else "" for slot in obj.material_slots))
+
+
+# mesh pointer -> [fingerprint, loop_vertex, loop_uv, loop_material, slot_vertices]
+MESH_DATA_CACHE = {}
+
+
+def get_mesh_data(obj, mesh_fingerprint = None):
+    """Returns the bulk read loop data of the mesh (see get_mesh_loop_data) and, for each material slot,
+       the sorted array of the vertex indices its polygons use.
+       Cached per mesh until the mesh fingerprint changes.
+    """
+
+    key = obj.data.as_pointer()
+    fingerprint = mesh_fingerprint if mesh_fingerprint else get_mesh_fingerprint(obj)
+    cached = MESH_DATA_CACHE.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1:]
+
+    loop_vertex, loop_uv, loop_material = get_mesh_loop_data(obj.data)
+    used = np.zeros(len(obj.data.vertices), dtype = bool)
+    slot_vertices = []
+    for slot_index in range(0, len(obj.material_slots)):
+        used.fill(False)
+        used[loop_vertex[loop_material == slot_index]] = True
+        slot_vertices.append(np.flatnonzero(used))
+
+    MESH_DATA_CACHE[key] = [fingerprint, loop_vertex, loop_uv, loop_material, slot_vertices]
+    return loop_vertex, loop_uv, loop_material, slot_vertices
+
+
+def clear_mesh_caches():
+    MESH_DATA_CACHE.clear()
+    EYE_RADIAL_CACHE.clear()
+    MESH_UV_HASH.clear()
+
+
+# mesh custom properties holding the fingerprint the vertex groups were last generated from
+EYE_GROUPS_FINGERPRINT = vars.NODE_PREFIX + "eye_groups_fingerprint"
+OCCLUSION_GROUPS_FINGERPRINT = vars.NODE_PREFIX + "occlusion_groups_fingerprint"
+TEARLINE_GROUPS_FINGERPRINT = vars.NODE_PREFIX + "tearline_groups_fingerprint"
+# mesh pointer -> hash of the uvs the per mesh caches were built from
+MESH_UV_HASH = {}
+
+
+def get_vertex_groups_fingerprint(obj, group_names, *values, mesh_fingerprint = None, uv_hash = None):
+    """Returns a fingerprint of everything a vertex group generator depends on: the mesh topology
+       and material slots, a hash of the uvs, the generated group names and the input values.
+       Unless an already known uv hash is given, hashes the uvs and drops the per mesh caches
+       if they have changed since the caches were built.
+    """
+
+    mesh = obj.data
+    if uv_hash is None:
+        loop_uv = np.empty(len(mesh.loops) * 2, dtype = np.float32)
+        if len(mesh.uv_layers) > 0:
+            mesh.uv_layers[0].data.foreach_get("uv", loop_uv)
+        else:
+            loop_uv.fill(0.0)
+        uv_hash = hashlib.sha1(loop_uv.tobytes()).hexdigest()
+
+        key = mesh.as_pointer()
+        if MESH_UV_HASH.get(key) != uv_hash:
+            MESH_DATA_CACHE.pop(key, None)
+            EYE_RADIAL_CACHE.pop(key, None)
+            MESH_UV_HASH[key] = uv_hash
+
+    if not mesh_fingerprint:
+        mesh_fingerprint = get_mesh_fingerprint(obj)
+    fingerprint = hashlib.sha1(uv_hash.encode())
+    fingerprint.update(str([mesh_fingerprint, group_names, values]).encode())
+    return fingerprint.hexdigest()
+
+
+def vertex_groups_unchanged(obj, prop_name, group_names, fingerprint):
+    """Returns True if the vertex groups exist and were last generated with the same fingerprint.
+    """
+
+    if obj.data.get(prop_name) != fingerprint:
+        return False
+    for name in group_names:
+        if name not in obj.vertex_groups:
+            return False
+    return True
 
 
-def set_vertex_group(obj, vertex_group, value):
-    all_verts = []
-    for v in obj.data.vertices:
-        all_verts.append(v.index)
-    vertex_group.add(all_verts, value, 'ADD')
+def smoothstep_array(edge0, edge1, x):
+    x = np.clip((x - edge0) / (edge1 - edge0), 0.0, 1.0)
+    return x * x * (3 - 2 * x)
 
 
 def generate_eye_occlusion_vertex_groups(obj, mat_left, mat_right):
 
+    group_names = [ name + side for side in ["_L", "_R"]
+                    for name in [vars.OCCLUSION_GROUP_INNER, vars.OCCLUSION_GROUP_OUTER, vars.OCCLUSION_GROUP_TOP,
+                                 vars.OCCLUSION_GROUP_BOTTOM, vars.OCCLUSION_GROUP_ALL] ]
+    fingerprint = get_vertex_groups_fingerprint(obj, group_names, get_material_name(mat_left), get_material_name(mat_right))
+    if vertex_groups_unchanged(obj, OCCLUSION_GROUPS_FINGERPRINT, group_names, fingerprint):
+        utils.log_info("Eye occlusion vertex groups unchanged: " + obj.name)
+        return
+
     vertex_group_inner_l = add_vertex_group(obj, vars.OCCLUSION_GROUP_INNER + "_L")
     vertex_group_outer_l = add_vertex_group(obj, vars.OCCLUSION_GROUP_OUTER + "_L")
     vertex_group_top_l = add_vertex_group(obj, vars.OCCLUSION_GROUP_TOP + "_L")
@@ -58,55 +252,52 @@ def generate_eye_occlusion_vertex_groups(obj, mat_left, mat_right):
     vertex_group_bottom_r = add_vertex_group(obj, vars.OCCLUSION_GROUP_BOTTOM + "_R")
     vertex_group_all_r = add_vertex_group(obj, vars.OCCLUSION_GROUP_ALL + "_R")
 
-    mesh = obj.data
-    ul = mesh.uv_layers[0]
-    index = [0]
-    for poly in mesh.polygons:
-        for loop_index in poly.loop_indices:
-            loop_entry = mesh.loops[loop_index]
-            vertex = mesh.vertices[loop_entry.vertex_index]
-            uv = ul.data[loop_entry.index].uv
-            index[0] = vertex.index
-
-            slot = obj.material_slots[poly.material_index]
-            if slot.material == mat_left:
-                vertex_group_inner_l.add(index, uv.x, 'REPLACE')
-                vertex_group_outer_l.add(index, 1.0 - uv.x, 'REPLACE')
-                vertex_group_top_l.add(index, uv.y, 'REPLACE')
-                vertex_group_bottom_l.add(index, 1.0 - uv.y, 'REPLACE')
-                vertex_group_all_l.add([vertex.index], 1.0, 'REPLACE')
-            elif slot.material == mat_right:
-                vertex_group_inner_r.add(index, uv.x, 'REPLACE')
-                vertex_group_outer_r.add(index, 1.0 - uv.x, 'REPLACE')
-                vertex_group_top_r.add(index, uv.y, 'REPLACE')
-                vertex_group_bottom_r.add(index, 1.0 - uv.y, 'REPLACE')
-                vertex_group_all_r.add([vertex.index], 1.0, 'REPLACE')
+    loop_vertex, loop_uv, loop_material, slot_vertices = get_mesh_data(obj)
+
+    for material, exclude, groups in [
+            [mat_left, None, [vertex_group_inner_l, vertex_group_outer_l, vertex_group_top_l, vertex_group_bottom_l, vertex_group_all_l]],
+            [mat_right, mat_left, [vertex_group_inner_r, vertex_group_outer_r, vertex_group_top_r, vertex_group_bottom_r, vertex_group_all_r]]]:
+        mask = get_material_slot_mask(obj, loop_material, material, exclude)
+        verts, loops = get_last_loop_per_vertex(loop_vertex, mask)
+        if len(verts) == 0:
+            continue
+        uv = loop_uv[loops]
+        inner, outer, top, bottom, everything = groups
+        set_vertex_group_weights(inner, verts, uv[:, 0])
+        set_vertex_group_weights(outer, verts, 1.0 - uv[:, 0])
+        set_vertex_group_weights(top, verts, uv[:, 1])
+        set_vertex_group_weights(bottom, verts, 1.0 - uv[:, 1])
+        everything.add(verts.tolist(), 1.0, 'REPLACE')
+
+    obj.data[OCCLUSION_GROUPS_FINGERPRINT] = fingerprint
 
 
 def generate_tearline_vertex_groups(obj, mat_left, mat_right):
 
+    group_names = [ name + side for side in ["_L", "_R"] for name in [vars.TEARLINE_GROUP_INNER, vars.TEARLINE_GROUP_ALL] ]
+    fingerprint = get_vertex_groups_fingerprint(obj, group_names, get_material_name(mat_left), get_material_name(mat_right))
+    if vertex_groups_unchanged(obj, TEARLINE_GROUPS_FINGERPRINT, group_names, fingerprint):
+        utils.log_info("Tearline vertex groups unchanged: " + obj.name)
+        return
+
     vertex_group_inner_l = add_vertex_group(obj, vars.TEARLINE_GROUP_INNER + "_L")
     vertex_group_all_l = add_vertex_group(obj, vars.TEARLINE_GROUP_ALL + "_L")
     vertex_group_inner_r = add_vertex_group(obj, vars.TEARLINE_GROUP_INNER + "_R")
     vertex_group_all_r = add_vertex_group(obj, vars.TEARLINE_GROUP_ALL + "_R")
 
-    mesh = obj.data
-    ul = mesh.uv_layers[0]
-    for poly in mesh.polygons:
-        for loop_index in poly.loop_indices:
-            loop_entry = mesh.loops[loop_index]
-            vertex = mesh.vertices[loop_entry.vertex_index]
-            uv = ul.data[loop_entry.index].uv
-            weight = 1.0 - utils.smoothstep(0, 0.1, abs(uv.x - 0.5))
+    loop_vertex, loop_uv, loop_material, slot_vertices = get_mesh_data(obj)
 
-            slot = obj.material_slots[poly.material_index]
-            if slot.material == mat_left:
-                vertex_group_inner_l.add([vertex.index], weight, 'REPLACE')
-                vertex_group_all_l.add([vertex.index], 1.0, 'REPLACE')
+    for material, exclude, inner, everything in [[mat_left, None, vertex_group_inner_l, vertex_group_all_l],
+                                                 [mat_right, mat_left, vertex_group_inner_r, vertex_group_all_r]]:
+        mask = get_material_slot_mask(obj, loop_material, material, exclude)
+        verts, loops = get_last_loop_per_vertex(loop_vertex, mask)
+        if len(verts) == 0:
+            continue
+        weights = 1.0 - smoothstep_array(0, 0.1, np.abs(loop_uv[loops, 0] - 0.5))
+        set_vertex_group_weights(inner, verts, weights)
+        everything.add(verts.tolist(), 1.0, 'REPLACE')
 
-            elif slot.material == mat_right:
-                vertex_group_inner_r.add([vertex.index], weight, 'REPLACE')
-                vertex_group_all_r.add([vertex.index], 1.0, 'REPLACE')
+    obj.data[TEARLINE_GROUPS_FINGERPRINT] = fingerprint
 
 
 def rebuild_eye_vertex_groups(chr_cache):
@@ -122,50 +313,92 @@ def rebuild_eye_vertex_groups(chr_cache):
                 generate_eye_vertex_groups(obj, mat_left, mat_right, cache_left, cache_right)
 
 
+# mesh pointer -> [fingerprint, [[left verts, left radial distances], [right verts, right radial distances]]]
+EYE_RADIAL_CACHE = {}
+
+
+def get_eye_radial_key(mesh_fingerprint, mat_left, mat_right):
+    return (mesh_fingerprint, get_material_name(mat_left), get_material_name(mat_right))
+
+
+def get_cached_eye_uv_hash(obj, radial_key):
+    """Returns the uv hash the eye radial distances were cached with, if they are still cached for the same
+       mesh topology and eye materials, so the iris sliders can skip re-hashing the uvs.
+    """
+
+    cached = EYE_RADIAL_CACHE.get(obj.data.as_pointer())
+    if cached and cached[0] == radial_key:
+        return cached[2]
+    return None
+
+
+def get_eye_radial_distances(obj, mat_left, mat_right, mesh_fingerprint = None):
+    """Returns the vertices of the left and right eye materials with their uv distances from the center of the eye,
+       cached per mesh so that the iris sliders only need to recalculate the weights.
+    """
+
+    key = obj.data.as_pointer()
+    if not mesh_fingerprint:
+        mesh_fingerprint = get_mesh_fingerprint(obj)
+    radial_key = get_eye_radial_key(mesh_fingerprint, mat_left, mat_right)
+    cached = EYE_RADIAL_CACHE.get(key)
+    if cached and cached[0] == radial_key:
+        return cached[1]
+
+    loop_vertex, loop_uv, loop_material, slot_vertices = get_mesh_data(obj, mesh_fingerprint)
+    loop_radial = np.hypot(loop_uv[:, 0] - 0.5, loop_uv[:, 1] - 0.5)
+    sides = []
+    for material, exclude in [[mat_left, None], [mat_right, mat_left]]:
+        mask = get_material_slot_mask(obj, loop_material, material, exclude)
+        verts, loops = get_last_loop_per_vertex(loop_vertex, mask)
+        sides.append([verts, loop_radial[loops]])
+
+    EYE_RADIAL_CACHE[key] = [radial_key, sides, MESH_UV_HASH.get(key)]
+    return sides
+
+
 def generate_eye_vertex_groups(obj, mat_left, mat_right, cache_left, cache_right):
     prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
 
-    vertex_group_l = add_vertex_group(obj, prefs.eye_displacement_group + "_L")
-    vertex_group_r = add_vertex_group(obj, prefs.eye_displacement_group + "_R")
-
-    mesh = obj.data
-    ul = mesh.uv_layers[0]
-    for poly in mesh.polygons:
-        for loop_index in poly.loop_indices:
-            loop_entry = mesh.loops[loop_index]
-            vertex = mesh.vertices[loop_entry.vertex_index]
-            uv = ul.data[loop_entry.index].uv
-            x = uv.x - 0.5
-            y = uv.y - 0.5
-            radial = math.sqrt(x * x + y * y)
-
-            slot = obj.material_slots[poly.material_index]
-            if slot.material == mat_left:
-                iris_scale = cache_left.parameters.eye_iris_scale
-                iris_radius = cache_left.parameters.eye_iris_radius
-                depth_radius = cache_left.parameters.eye_iris_depth_radius
-                radius = iris_scale * iris_radius * depth_radius
-                #weight = 1.0 - utils.saturate(utils.smoothstep(0, radius, radial))
-                weight = utils.saturate(utils.remap(0, radius, 1.0, 0.0, radial))
-                vertex_group_l.add([vertex.index], weight, 'REPLACE')
-
-            elif slot.material == mat_right:
-                iris_scale = cache_right.parameters.eye_iris_scale
-                iris_radius = cache_right.parameters.eye_iris_radius
-                depth_radius = cache_right.parameters.eye_iris_depth_radius
-                radius = iris_scale * iris_radius * depth_radius
-                #weight = 1.0 - utils.saturate(utils.smoothstep(0, radius, radial))
-                weight = utils.saturate(utils.remap(0, radius, 1.0, 0.0, radial))
-                vertex_group_r.add([vertex.index], weight, 'REPLACE')
+    radii = []
+    for cache in [cache_left, cache_right]:
+        if cache is None:
+            radii.append(None)
+        else:
+            iris_scale = cache.parameters.eye_iris_scale
+            iris_radius = cache.parameters.eye_iris_radius
+            depth_radius = cache.parameters.eye_iris_depth_radius
+            radii.append(max(iris_scale * iris_radius * depth_radius, 0.000001))
+
+    group_names = [prefs.eye_displacement_group + "_L", prefs.eye_displacement_group + "_R"]
+    mesh_fingerprint = get_mesh_fingerprint(obj)
+    # while the radial distances are cached for the same topology and materials, the iris sliders only remap
+    # them to weights, without re-hashing the uvs (uv edits are picked up after file load, undo or import)
+    uv_hash = get_cached_eye_uv_hash(obj, get_eye_radial_key(mesh_fingerprint, mat_left, mat_right))
+    fingerprint = get_vertex_groups_fingerprint(obj, group_names, get_material_name(mat_left), get_material_name(mat_right), radii,
+                                                mesh_fingerprint = mesh_fingerprint, uv_hash = uv_hash)
+    if vertex_groups_unchanged(obj, EYE_GROUPS_FINGERPRINT, group_names, fingerprint):
+        return
+
+    vertex_group_l = add_vertex_group(obj, group_names[0])
+    vertex_group_r = add_vertex_group(obj, group_names[1])
+
+    sides = get_eye_radial_distances(obj, mat_left, mat_right, mesh_fingerprint)
+    for vertex_group, radius, side in zip([vertex_group_l, vertex_group_r], radii, sides):
+        verts, radial = side
+        if radius is None or len(verts) == 0:
+            continue
+        #weight = 1.0 - utils.saturate(utils.smoothstep(0, radius, radial))
+        weights = 1.0 - radial / radius
+        set_vertex_group_weights(vertex_group, verts, weights)
+
+    obj.data[EYE_GROUPS_FINGERPRINT] = fingerprint
 
 
 def get_material_vertices(obj, mat):
-    verts = []
-    mesh = obj.data
-    for poly in mesh.polygons:
-        poly_mat = obj.material_slots[poly.material_index].material
-        if poly_mat == mat:
-            for vert in poly.vertices:
-                if vert not in verts:
-                    verts.append(vert)
+    slot_vertices = get_mesh_data(obj)[3]
+    verts = [ slot_vertices[i] for i, slot in enumerate(obj.material_slots) if slot.material == mat ]
+    if len(verts) == 0:
+        return []
+    verts = np.unique(np.concatenate(verts)).tolist()
     return verts
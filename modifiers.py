@@ -14,7 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
+
 import bpy
+import numpy as np
 
 from . import materials, meshutils, utils, vars
 
@@ -145,6 +148,8 @@ def fix_eye_mod_order(obj):
 
 def remove_eye_modifiers(obj):
     if obj and obj.type == "MESH":
+        # remove any frozen displacement before the modifiers are re-created
+        thaw_eye_modifiers(obj)
         for mod in obj.modifiers:
             if vars.NODE_PREFIX in mod.name:
                 if mod.type == "DISPLACE" or mod.type == "UV_WARP" or mod.type == "VERTEX_WEIGHT_EDIT":
@@ -286,4 +291,157 @@ def has_modifier(obj, modifier_type):
         for mod in obj.modifiers:
             if mod.type == modifier_type:
                 return True
-    return False
\ No newline at end of file
+    return False
+
+# Freezing for playback
+#
+
+FROZEN_MODIFIERS_PROP = vars.NODE_PREFIX + "frozen_modifiers"
+FROZEN_SHAPE_KEY = vars.NODE_PREFIX + "Frozen_Displacement"
+FROZEN_UV_LAYER = vars.NODE_PREFIX + "Frozen_UV"
+
+
+def get_eye_displacement_modifiers(obj):
+    """Returns the enabled displacement and uv warp modifiers added by the eye, eye occlusion and tearline setup.
+    """
+    mods = []
+    if obj and obj.type == "MESH":
+        for mod in obj.modifiers:
+            if vars.NODE_PREFIX in mod.name and (mod.type == "DISPLACE" or mod.type == "UV_WARP"):
+                if mod.show_viewport or mod.show_render:
+                    mods.append(mod)
+    return mods
+
+
+def is_frozen(obj):
+    return obj is not None and FROZEN_MODIFIERS_PROP in obj
+
+
+def get_evaluated_mesh_data(obj, get_uvs = False):
+    """Returns the vertex positions (and the active layer uvs) of the evaluated mesh.
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    eval_obj = obj.evaluated_get(depsgraph)
+    mesh = eval_obj.to_mesh()
+    co = np.empty(len(mesh.vertices) * 3, dtype = np.float32)
+    mesh.vertices.foreach_get("co", co)
+    uvs = None
+    if get_uvs and mesh.uv_layers.active:
+        uvs = np.empty(len(mesh.loops) * 2, dtype = np.float32)
+        mesh.uv_layers.active.data.foreach_get("uv", uvs)
+    eval_obj.to_mesh_clear()
+    return co, uvs
+
+
+def freeze_eye_modifiers(obj):
+    """Evaluates the eye displacement modifiers once, writes the displacement into a shape key and the uv warp
+       into a new render uv layer, then disables the modifiers so they are not evaluated again on every frame.
+       The original modifier states are stored on the object so they can be restored with thaw_eye_modifiers().
+    """
+
+    if is_frozen(obj):
+        return False
+    eye_mods = get_eye_displacement_modifiers(obj)
+    if not eye_mods:
+        return False
+
+    mesh = obj.data
+    num_verts = len(mesh.vertices)
+    num_loops = len(mesh.loops)
+    has_warp = False
+    states = {}
+    for mod in obj.modifiers:
+        states[mod.name] = [mod.show_viewport, mod.show_render]
+        # evaluate only the eye modifiers
+        if mod in eye_mods:
+            mod.show_viewport = True
+            has_warp = has_warp or mod.type == "UV_WARP"
+        else:
+            mod.show_viewport = False
+
+    try:
+        frozen_co, frozen_uvs = get_evaluated_mesh_data(obj, has_warp)
+        for mod in eye_mods:
+            mod.show_viewport = False
+        base_co = get_evaluated_mesh_data(obj)[0]
+    finally:
+        for mod in obj.modifiers:
+            if mod not in eye_mods:
+                mod.show_viewport = states[mod.name][0]
+
+    if len(frozen_co) != num_verts * 3 or len(base_co) != num_verts * 3:
+        utils.log_warn("Unable to freeze modifiers on: " + obj.name + ", the modifiers change the mesh topology.")
+        for mod in eye_mods:
+            mod.show_viewport = states[mod.name][0]
+        return False
+
+    frozen = { "modifiers": {}, "basis": False, "uv_layer": "", "active_render": "" }
+
+    # displacement into a shape key, relative to the basis so it mixes with any other shape keys
+    if not mesh.shape_keys:
+        obj.shape_key_add(name = "Basis", from_mix = False)
+        frozen["basis"] = True
+    basis_co = np.empty(num_verts * 3, dtype = np.float32)
+    mesh.shape_keys.reference_key.data.foreach_get("co", basis_co)
+    shape_key = obj.shape_key_add(name = FROZEN_SHAPE_KEY, from_mix = False)
+    shape_key.data.foreach_set("co", basis_co + frozen_co - base_co)
+    shape_key.value = 1.0
+
+    # warped uvs into a new uv layer, used for rendering
+    uv_layer = None
+    if frozen_uvs is not None and len(frozen_uvs) == num_loops * 2:
+        old_render = [ layer.name for layer in mesh.uv_layers if layer.active_render ]
+        uv_layer = mesh.uv_layers.new(name = FROZEN_UV_LAYER)
+        if uv_layer:
+            uv_layer.data.foreach_set("uv", frozen_uvs)
+            uv_layer.active_render = True
+            frozen["uv_layer"] = uv_layer.name
+            frozen["active_render"] = old_render[0] if old_render else ""
+
+    for mod in eye_mods:
+        if mod.type == "UV_WARP" and not uv_layer:
+            # couldn't freeze the uvs, leave the uv warp running
+            mod.show_viewport = states[mod.name][0]
+            continue
+        frozen["modifiers"][mod.name] = states[mod.name]
+        mod.show_viewport = False
+        mod.show_render = False
+
+    obj[FROZEN_MODIFIERS_PROP] = json.dumps(frozen)
+    utils.log_info("Eye modifiers frozen on: " + obj.name)
+    return True
+
+
+def thaw_eye_modifiers(obj):
+    """Removes the frozen shape key and uv layer and restores the modifiers disabled by freeze_eye_modifiers().
+    """
+
+    if not is_frozen(obj):
+        return False
+
+    try:
+        frozen = json.loads(obj[FROZEN_MODIFIERS_PROP])
+    except Exception as e:
+        utils.log_error("Unable to read frozen modifier state on: " + obj.name, e)
+        del obj[FROZEN_MODIFIERS_PROP]
+        return False
+
+    mesh = obj.data
+    for mod_name in frozen["modifiers"]:
+        mod = obj.modifiers.get(mod_name)
+        if mod:
+            mod.show_viewport, mod.show_render = frozen["modifiers"][mod_name]
+
+    if mesh.shape_keys and FROZEN_SHAPE_KEY in mesh.shape_keys.key_blocks:
+        obj.shape_key_remove(mesh.shape_keys.key_blocks[FROZEN_SHAPE_KEY])
+        if frozen["basis"] and len(mesh.shape_keys.key_blocks) == 1:
+            obj.shape_key_remove(mesh.shape_keys.key_blocks[0])
+
+    if frozen["uv_layer"] and frozen["uv_layer"] in mesh.uv_layers:
+        if frozen["active_render"] in mesh.uv_layers:
+            mesh.uv_layers[frozen["active_render"]].active_render = True
+        mesh.uv_layers.remove(mesh.uv_layers[frozen["uv_layer"]])
+
+    del obj[FROZEN_MODIFIERS_PROP]
+    utils.log_info("Eye modifiers restored on: " + obj.name)
+    return True
@@ -15,8 +15,10 @@
 # along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import re
 
 import bpy
+import numpy as np
 import mathutils
 
 from . import utils, vars
@@ -87,7 +89,70 @@ def has_connected_input(node, socket):
     return False
 
 
+# node tree pointer -> [signature, { node id: [node names] }, { node ids not found since the last rebuild }]
+# (only node names are kept, never references to nodes, which may have been freed since)
+NODE_ID_INDEX = {}
+# the (id) tokens in the add-on node names, e.g. "(rl_skin_shader)", "(rl_skin_shader_BSDF)", "(tiling_..._mapping)"
+NODE_ID_PATTERN = re.compile(r"\([^()]*\)")
+
+
+def clear_node_id_index():
+    NODE_ID_INDEX.clear()
+
+
+def get_node_id_index(nodes, rebuild = False):
+    """Returns the index entry [signature, { node id: [node names] }, missed ids] for the node tree the nodes belong to.
+
+    Built once per node tree and rebuilt when the node count or the last node changes,
+    on a lookup of a removed or renamed node, or of a node id not found since the last rebuild.
+    """
+
+    key = nodes.id_data.as_pointer()
+    num_nodes = len(nodes)
+    signature = (num_nodes, nodes[num_nodes - 1].name if num_nodes > 0 else "")
+    cached = NODE_ID_INDEX.get(key)
+    if cached and cached[0] == signature and not rebuild:
+        return cached
+
+    index = {}
+    for node in nodes:
+        if vars.NODE_PREFIX in node.name:
+            for node_id in NODE_ID_PATTERN.findall(node.name):
+                index.setdefault(node_id, []).append(node.name)
+    cached = [signature, index, set()]
+    NODE_ID_INDEX[key] = cached
+    return cached
+
+
+def find_nodes_by_id(nodes, id):
+    """Returns the add-on nodes with the (id) in their name, in node order.
+    """
+
+    # a stale index entry (a removed or renamed node) or a miss triggers one rebuild of the index
+    for rebuild in [False, True]:
+        entry = get_node_id_index(nodes, rebuild)
+        names = entry[1].get(id)
+        if names is None:
+            if id in entry[2]:
+                # already not found since the index was last rebuilt
+                return []
+            if rebuild:
+                entry[2].add(id)
+            continue
+        found = [nodes.get(name) for name in names]
+        if None not in found:
+            return found
+    return []
+
+
+def is_indexable(nodes, id):
+    return NODE_ID_PATTERN.fullmatch(id) is not None and hasattr(nodes, "id_data")
+
+
 def get_node_by_id(nodes, id):
+    if is_indexable(nodes, id):
+        found = find_nodes_by_id(nodes, id)
+        return found[0] if found else None
     for node in nodes:
         if vars.NODE_PREFIX in node.name and id in node.name:
             return node
@@ -95,6 +160,11 @@ def get_node_by_id(nodes, id):
 
 
 def get_node_by_id_and_type(nodes, id, type):
+    if is_indexable(nodes, id):
+        for node in find_nodes_by_id(nodes, id):
+            if node.type == type:
+                return node
+        return None
     for node in nodes:
         if vars.NODE_PREFIX in node.name and id in node.name and node.type == type:
             return node
@@ -276,11 +346,40 @@ def get_node_output(node, output, default):
     return default
 
 
+# socket input writes since the last reset: [requested, skipped as unchanged]
+SOCKET_WRITES = [0, 0]
+
+
+def reset_socket_write_stats():
+    SOCKET_WRITES[0] = 0
+    SOCKET_WRITES[1] = 0
+
+
+def get_socket_write_stats():
+    return SOCKET_WRITES[0], SOCKET_WRITES[1]
+
+
+def input_value_unchanged(current, value):
+    """True if the socket would store the same (float32) value(s) that it already holds.
+    """
+    try:
+        return np.array_equal(np.asarray(current, dtype=np.float32), np.asarray(value, dtype=np.float32))
+    except:
+        return False
+
+
 def set_node_input(node, socket, value):
 
     if node is not None:
         try:
-            node.inputs[socket].default_value = utils.match_dimensions(node.inputs[socket].default_value, value)
+            current = node.inputs[socket].default_value
+            value = utils.match_dimensions(current, value)
+            SOCKET_WRITES[0] += 1
+            # writing a socket tags the material for a shader recompile, even if the value is the same
+            if input_value_unchanged(current, value):
+                SOCKET_WRITES[1] += 1
+                return
+            node.inputs[socket].default_value = value
         except:
             utils.log_detail("Unable to set input: " + node.name + "[" + str(socket) + "]")
 
@@ -615,15 +714,9 @@ def get_shader_nodes(mat, shader_name):
         shader_id = "(" + str(shader_name) + ")"
         bsdf_id = "(" + str(shader_name) + "_BSDF)"
         mix_id = "(" + str(shader_name) + "_MIX)"
-        shader_node = bsdf_node = mix_node = None
-        for node in nodes:
-            if vars.NODE_PREFIX in node.name:
-                if shader_id in node.name:
-                    shader_node = node
-                elif bsdf_id in node.name:
-                    bsdf_node = node
-                elif mix_id in node.name:
-                    mix_node = node
+        # the last matching node of each
+        found = [ find_nodes_by_id(nodes, node_id) for node_id in [bsdf_id, shader_id, mix_id] ]
+        bsdf_node, shader_node, mix_node = [ f[-1] if f else None for f in found ]
         return bsdf_node, shader_node, mix_node
     return None, None, None
 
@@ -503,6 +503,12 @@ class CC3MaterialParametersPanel(bpy.types.Panel):
         op.param = "RESET"
         op = column.operator("cc3.importer", icon="MOD_BUILD", text="Rebuild Node Groups")
         op.param ="REBUILD_NODE_GROUPS"
+        if characters.character_modifiers_frozen(chr_cache):
+            op = column.operator("cc3.character", icon="MOD_DISPLACE", text="Restore Eye Modifiers")
+            op.param = "THAW_MODIFIERS"
+        else:
+            op = column.operator("cc3.character", icon="FREEZE", text="Freeze Eye Modifiers")
+            op.param = "FREEZE_MODIFIERS"
 
 
 class CC3ToolsScenePanel(bpy.types.Panel):
@@ -56,6 +56,13 @@ TEXTURE_TYPES = [
     ["WEIGHTMAP", "Weight Map", ["weightmap"]],
 ]
 
+# texture types that only hold a single (grayscale) value
+SCALAR_TEXTURE_TYPES = [
+    "AO", "SPECULAR", "METALLIC", "ROUGHNESS", "ALPHA", "BUMP", "DISPLACE",
+    "TRANSMISSION", "SPECMASK", "MICRONMASK", "GRADIENTAO", "GUMSMASK", "INNERIRISMASK",
+    "HAIRROOT", "HAIRID", "WEIGHTMAP"
+]
+
 PBR_TYPES = [
     "DIFFUSE", "AO", "BLEND1", "SPECULAR", "METALLIC", "ROUGHNESS",
     "EMISSION", "ALPHA", "NORMAL", "BUMP", "DISPLACE"
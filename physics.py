@@ -341,12 +341,13 @@ def get_weight_map_image(obj, mat, create = False):
         cache = props.get_material_cache(mat)
         name = utils.strip_name(mat.name) + "_WeightMap"
         tex_size = int(props.physics_tex_size)
-        weight_map = bpy.data.images.new(name, tex_size, tex_size, is_data=True)
+        weight_map = imageutils.new_image(name, tex_size, tex_size, is_data=True)
         # make the image 'dirty' so it converts to a file based image which can be saved:
         weight_map.pixels[0] = 0.0
         weight_map.file_format = "PNG"
         weight_map.filepath_raw = os.path.join(cache.dir, name + ".png")
-        weight_map.save()
+        # weight maps only need one channel
+        imageutils.save_image_grayscale(weight_map)
         # keep track of which weight maps we created:
         cache.temp_weight_map = weight_map
         utils.log_info("Weight-map image: " + weight_map.name + " created and saved.")
@@ -38,11 +38,16 @@ def reset_preferences():
     prefs.refractive_eyes = "PARALLAX"
     prefs.eye_displacement_group = "CC_Eye_Displacement"
     prefs.max_texture_size = 4096
+    prefs.flow_normal_tile_size = 256
+    prefs.bake_fast_compression = False
+    prefs.bake_byte_buffers = True
     prefs.export_json_changes = True
     prefs.export_texture_changes = True
     prefs.export_bone_roll_fix = False
     prefs.export_bake_nodes = False
     prefs.export_bake_bump_to_normal = True
+    prefs.export_bake_cache = True
+    prefs.export_bake_packed = True
     prefs.cycles_sss_skin = 0.2
     prefs.cycles_sss_hair = 0.05
     prefs.cycles_sss_teeth = 0.1
@@ -154,6 +159,8 @@ class CC3ToolsAddonPreferences(bpy.types.AddonPreferences):
     export_bone_roll_fix: bpy.props.BoolProperty(default=False, name="Teeth bone fix", description="(Experimental) Apply zero roll to upper and lower teeth bones to fix teeth alignment problems re-importing to CC3")
     export_bake_nodes: bpy.props.BoolProperty(default=False, name="Bake custom nodes", description="(Very Experimental) Bake any custom nodes (non texture image) attached to shader texture map sockets on export.")
     export_bake_bump_to_normal: bpy.props.BoolProperty(default=False, name="Bake bump to normal maps", description="(Very Experimental) When both a bump map and a normal is present, bake the bump map into the normal. (CC3 materials can only have normal map or bump map.)")
+    export_bake_packed: bpy.props.BoolProperty(default=True, name="Pack scalar bakes", description="Bake up to three single channel texture sockets (roughness, metallic, AO...) of the same material in one bake, packed into the color channels, and split them into separate grayscale textures afterwards")
+    export_bake_cache: bpy.props.BoolProperty(default=True, name="Reuse cached bakes", description="Reuse previously baked textures in the Bake folder when the nodes being baked have not changed since")
 
     physics_group: bpy.props.StringProperty(default="CC_Physics", name="Physics Vertex Group Prefix")
 
@@ -167,6 +174,9 @@ class CC3ToolsAddonPreferences(bpy.types.AddonPreferences):
 
 
     max_texture_size: bpy.props.FloatProperty(default=4096, min=512, max=4096)
+    bake_fast_compression: bpy.props.BoolProperty(default=False, name="Fast bake compression", description="Use a faster, lighter PNG compression when writing baked and generated textures. Files will be larger")
+    bake_byte_buffers: bpy.props.BoolProperty(default=True, name="8-bit bake images", description="Create bake targets and weight maps as 8-bit byte images. Normal bakes always use float images for precision")
+    flow_normal_tile_size: bpy.props.IntProperty(default=256, min=0, max=8192, name="Flow map tile rows", description="Number of image rows processed at a time when generating normal maps from hair flow maps. Smaller tiles use less temporary memory. 0 processes the whole image at once")
 
     cycles_sss_skin: bpy.props.FloatProperty(default=0.2)
     cycles_sss_hair: bpy.props.FloatProperty(default=0.05)
@@ -238,6 +248,10 @@ class CC3ToolsAddonPreferences(bpy.types.AddonPreferences):
         layout.prop(self, "cycles_sss_tongue")
         layout.prop(self, "cycles_sss_eyes")
         layout.prop(self, "cycles_sss_default")
+        layout.label(text="Baking:")
+        layout.prop(self, "flow_normal_tile_size")
+        layout.prop(self, "bake_fast_compression")
+        layout.prop(self, "bake_byte_buffers")
         layout.label(text="Physics:")
         layout.prop(self, "physics")
         layout.prop(self, "physics_group")
@@ -247,6 +261,8 @@ class CC3ToolsAddonPreferences(bpy.types.AddonPreferences):
         layout.prop(self, "export_bone_roll_fix")
         layout.prop(self, "export_bake_nodes")
         layout.prop(self, "export_bake_bump_to_normal")
+        layout.prop(self, "export_bake_packed")
+        layout.prop(self, "export_bake_cache")
         layout.label(text="Debug Settings:")
         layout.prop(self, "log_level")
         op = layout.operator("cc3.setpreferences", icon="FILE_REFRESH", text="Reset to Defaults")
@@ -15,6 +15,7 @@
 # along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
 
 import bpy
+from bpy.app.handlers import persistent
 
 from . import imageutils, meshutils, materials, modifiers, nodeutils, shaders, params, physics, basic, jsonutils, utils, vars
 
@@ -79,11 +80,17 @@ def eye_close_update(self, context):
             pass
 
 
+# pending property updates: (character, material type, prop_name) -> [object name, material name, prop_name, update_mode]
+PROPERTY_UPDATES = {}
+# seconds to wait for more property changes before applying them
+PROPERTY_UPDATE_DELAY = 0.05
+# property updates applied by the update timer, i.e. after their undo step was pushed: key -> update
+DEFERRED_PROPERTY_UPDATES = {}
+
+
 def update_property(self, context, prop_name, update_mode = None):
     if vars.block_property_update: return
 
-    utils.start_timer()
-
     props = bpy.context.scene.CC3ImportProps
     chr_cache: CC3CharacterCache = props.get_context_character_cache(context)
 
@@ -92,40 +99,140 @@ def update_property(self, context, prop_name, update_mode = None):
         # get the context (currently active) material
         context_obj = context.object
         context_mat = utils.context_material(context)
-        context_mat_cache = chr_cache.get_material_cache(context_mat)
 
-        if context_obj and context_mat and context_mat_cache:
+        if update_mode is None:
+            update_mode = props.update_mode
+
+        if vars.immediate_property_update or bpy.app.background:
+            apply_property_update(chr_cache, context_obj, context_mat, prop_name, update_mode)
+        else:
+            schedule_property_update(chr_cache, context_obj, context_mat, prop_name, update_mode)
 
-            if update_mode is None:
-                update_mode = props.update_mode
 
-            all_materials_cache = chr_cache.get_all_materials_cache()
-            linked = get_linked_material_types(context_mat_cache)
-            paired = get_paired_material_types(context_mat_cache)
+def schedule_property_update(chr_cache, context_obj, context_mat, prop_name, update_mode):
+    """Records the property update to be applied on the next update timer tick.
+       Repeated updates of the same property (e.g. while dragging a slider) are coalesced into one,
+       which applies the latest value.
+    """
 
-            for mat_cache in all_materials_cache:
-                mat = mat_cache.material
+    context_mat_cache = chr_cache.get_material_cache(context_mat)
+    if context_obj and context_mat and context_mat_cache:
+        key = (chr_cache.import_name, chr_cache.character_id, context_mat_cache.material_type, prop_name)
+        PROPERTY_UPDATES[key] = [context_obj.name, context_mat.name, prop_name, update_mode]
+        if not bpy.app.timers.is_registered(flush_property_updates):
+            bpy.app.timers.register(flush_property_updates, first_interval = PROPERTY_UPDATE_DELAY)
 
-                if mat:
 
-                    if mat == context_mat:
-                        # Always update the currently active material
-                        update_shader_property(context_obj, mat, mat_cache, prop_name)
+def flush_property_updates():
+    """Applies all the pending property updates.
+    """
+
+    DEFERRED_PROPERTY_UPDATES.update(PROPERTY_UPDATES)
+    updates = list(PROPERTY_UPDATES.values())
+    PROPERTY_UPDATES.clear()
+    apply_property_updates(updates)
+    # don't repeat the timer
+    return None
+
+
+def apply_property_updates(updates):
+    props = bpy.context.scene.CC3ImportProps
+    for obj_name, mat_name, prop_name, update_mode in updates:
+        context_obj = bpy.data.objects.get(obj_name)
+        context_mat = bpy.data.materials.get(mat_name)
+        chr_cache = props.get_character_cache(context_obj, context_mat)
+        if chr_cache:
+            apply_property_update(chr_cache, context_obj, context_mat, prop_name, update_mode)
+
+
+def clear_property_updates():
+    PROPERTY_UPDATES.clear()
+    DEFERRED_PROPERTY_UPDATES.clear()
+    if bpy.app.timers.is_registered(flush_property_updates):
+        bpy.app.timers.unregister(flush_property_updates)
+
+
+@persistent
+def property_updates_load_handler(dummy):
+    """Pending property updates belong to the previous file, drop them.
+    """
+    clear_property_updates()
+
+
+@persistent
+def property_updates_undo_handler(dummy):
+    """The timer applies the shader node updates after the parameter's undo step has been pushed,
+       so undo and redo can restore parameter values without their node values. Re-sync the deferred
+       (and any pending) properties now, from the restored parameter values.
+       (Node inputs that already match are not re-written.)
+    """
+    if bpy.app.timers.is_registered(flush_property_updates):
+        bpy.app.timers.unregister(flush_property_updates)
+    DEFERRED_PROPERTY_UPDATES.update(PROPERTY_UPDATES)
+    PROPERTY_UPDATES.clear()
+    props = bpy.context.scene.CC3ImportProps
+    for obj_name, mat_name, prop_name, update_mode in DEFERRED_PROPERTY_UPDATES.values():
+        context_obj = bpy.data.objects.get(obj_name)
+        context_mat = bpy.data.materials.get(mat_name)
+        chr_cache = props.get_character_cache(context_obj, context_mat)
+        if chr_cache:
+            resync_property_update(chr_cache, context_obj, context_mat, prop_name)
+
+
+def resync_property_update(chr_cache, context_obj, context_mat, prop_name):
+    """Re-applies the property's current values to the shader nodes of the materials a property update
+       could have changed, without copying the value between the linked materials.
+    """
+
+    context_mat_cache = chr_cache.get_material_cache(context_mat)
+
+    if context_obj and context_mat and context_mat_cache:
+
+        material_types = ([context_mat_cache.material_type] + get_linked_material_types(context_mat_cache) +
+                          get_paired_material_types(context_mat_cache))
+        for mat_cache in chr_cache.get_all_materials_cache():
+            if mat_cache.material and mat_cache.material_type in material_types:
+                update_shader_property(context_obj, mat_cache.material, mat_cache, prop_name)
+
+        if prop_name in ["eye_iris_depth_radius", "eye_iris_scale", "eye_iris_radius"]:
+            meshutils.rebuild_eye_vertex_groups(chr_cache)
+
 
-                    elif mat_cache.material_type in paired:
-                        # Update paired materials
+def apply_property_update(chr_cache, context_obj, context_mat, prop_name, update_mode):
+
+    utils.start_timer()
+
+    context_mat_cache = chr_cache.get_material_cache(context_mat)
+
+    if context_obj and context_mat and context_mat_cache:
+
+        all_materials_cache = chr_cache.get_all_materials_cache()
+        linked = get_linked_material_types(context_mat_cache)
+        paired = get_paired_material_types(context_mat_cache)
+
+        for mat_cache in all_materials_cache:
+            mat = mat_cache.material
+
+            if mat:
+
+                if mat == context_mat:
+                    # Always update the currently active material
+                    update_shader_property(context_obj, mat, mat_cache, prop_name)
+
+                elif mat_cache.material_type in paired:
+                    # Update paired materials
+                    set_linked_property(prop_name, context_mat_cache, mat_cache)
+                    update_shader_property(context_obj, mat, mat_cache, prop_name)
+
+                elif update_mode == "UPDATE_LINKED":
+                    # Update all other linked materials in the imported objects material cache:
+                    if mat_cache.material_type in linked:
                         set_linked_property(prop_name, context_mat_cache, mat_cache)
                         update_shader_property(context_obj, mat, mat_cache, prop_name)
 
-                    elif update_mode == "UPDATE_LINKED":
-                        # Update all other linked materials in the imported objects material cache:
-                        if mat_cache.material_type in linked:
-                            set_linked_property(prop_name, context_mat_cache, mat_cache)
-                            update_shader_property(context_obj, mat, mat_cache, prop_name)
-
-            # these properties will cause the eye displacement vertex group to change...
-            if prop_name in ["eye_iris_depth_radius", "eye_iris_scale", "eye_iris_radius"]:
-                meshutils.rebuild_eye_vertex_groups(chr_cache)
+        # these properties will cause the eye displacement vertex group to change...
+        if prop_name in ["eye_iris_depth_radius", "eye_iris_scale", "eye_iris_radius"]:
+            meshutils.rebuild_eye_vertex_groups(chr_cache)
 
     utils.log_timer("update_property()", "ms")
 
@@ -165,19 +272,25 @@ def get_paired_material_types(cache):
 
 def set_linked_property(prop_name, active_cache, cache):
     vars.block_property_update = True
-    code = ""
 
     try:
-        code = "cache.parameters." + prop_name + " = active_cache.parameters." + prop_name
-        exec(code, None, locals())
+        setattr(cache.parameters, prop_name, getattr(active_cache.parameters, prop_name))
     except Exception as e:
-        utils.log_error("set_linked_property(): Unable to evaluate: " + code, e)
+        utils.log_error("set_linked_property(): Unable to set: " + prop_name, e)
 
     vars.block_property_update = False
 
 
 def update_shader_property(obj, mat, mat_cache, prop_name):
-    props = bpy.context.scene.CC3ImportProps
+    plan = plan_shader_property([], obj, mat, mat_cache, prop_name)
+    shaders.apply_update_plan(plan)
+    if mat and mat_cache:
+        update_parameter_snapshot(mat, mat_cache, prop_name)
+
+
+def plan_shader_property(plan, obj, mat, mat_cache, prop_name):
+    """Adds the updates of all the targets driven by the parameter to the update plan.
+    """
 
     if mat and mat.node_tree and mat_cache:
 
@@ -187,94 +300,62 @@ def update_shader_property(obj, mat, mat_cache, prop_name):
 
         if shader_def:
 
-            if "inputs" in shader_def.keys():
-                update_shader_input(shader_node, mat_cache, prop_name, shader_def["inputs"])
+            for target_type, target_def, texture_type in shaders.get_prop_targets(shader_def, prop_name):
+
+                if target_type == "INPUT":
+                    shaders.plan_node_input(plan, mat, shader_node, target_def[0], shaders.eval_input_param(target_def, mat_cache))
 
-            if "bsdf" in shader_def.keys():
-                update_bsdf_input(bsdf_node, mat_cache, prop_name, shader_def["bsdf"])
+                elif target_type == "BSDF":
+                    shaders.plan_node_input(plan, mat, bsdf_node, target_def[0], shaders.eval_input_param(target_def, mat_cache))
 
-            if "textures" in shader_def.keys():
-                update_shader_tiling(shader_name, mat, mat_cache, prop_name, shader_def["textures"])
+                elif target_type == "TILING":
+                    tiling_node = nodeutils.get_tiling_node(mat, shader_name, texture_type)
+                    shaders.plan_node_input(plan, mat, tiling_node, "Tiling", shaders.eval_tiling_param(target_def, mat_cache))
 
-            if "mapping" in shader_def.keys():
-                update_shader_mapping(shader_name, mat, mat_cache, prop_name, shader_def["mapping"])
+                elif target_type == "MAPPING":
+                    mapping_node = nodeutils.get_tiling_node(mat, shader_name, texture_type)
+                    shaders.plan_node_input(plan, mat, mapping_node, target_def[1], shaders.eval_tiling_param(target_def, mat_cache, 2))
 
-            if "modifiers" in shader_def.keys():
-                update_object_modifier(obj, mat_cache, prop_name, shader_def["modifiers"])
+                elif target_type == "MODIFIER":
+                    plan_object_modifier(plan, obj, mat_cache, target_def)
 
-            if "settings" in shader_def.keys():
-                update_material_setting(mat, mat_cache, prop_name, shader_def["settings"])
+                elif target_type == "SETTING":
+                    plan_material_setting(plan, mat, mat_cache, target_def)
 
         else:
             utils.log_error("No shader definition for: " + shader_name)
 
+    return plan
+
+
+def plan_object_modifier(plan, obj, mat_cache, mod_def):
+    material_type = mod_def[1]
+    mod_type = mod_def[2]
+    mod_name = mod_def[3]
+    code = mod_def[4]
+
+    if mat_cache.material_type == material_type:
+        mod = modifiers.get_object_modifier(obj, mod_type, mod_name)
+        if mod:
+            try:
+                path, evaluate = shaders.compile_assignment(code)
+                value = evaluate(mod, None, mat_cache.parameters)
+                plan.append(["MODIFIER", obj.name, mod.name, path[1:], shaders.get_plan_value(value)])
+            except Exception as e:
+                utils.log_error("plan_object_modifier(): unable to evaluate: " + code, e)
 
-def update_shader_input(shader_node, mat_cache, prop_name, input_defs):
-    for input_def in input_defs:
-        if prop_name in input_def[2:]:
-            nodeutils.set_node_input(shader_node, input_def[0], shaders.eval_input_param(input_def, mat_cache))
-
-
-def update_bsdf_input(bsdf_node, mat_cache, prop_name, bsdf_defs):
-    for input_def in bsdf_defs:
-        if prop_name in input_def[2:]:
-            nodeutils.set_node_input(bsdf_node, input_def[0], shaders.eval_input_param(input_def, mat_cache))
-
-
-def update_shader_tiling(shader_name, mat, mat_cache, prop_name, texture_defs):
-    for texture_def in texture_defs:
-        if len(texture_def) > 5:
-            tiling_props = texture_def[5:]
-            texture_type = texture_def[2]
-            if prop_name in tiling_props:
-                tiling_node = nodeutils.get_tiling_node(mat, shader_name, texture_type)
-                nodeutils.set_node_input(tiling_node, "Tiling", shaders.eval_tiling_param(texture_def, mat_cache))
-
-
-def update_shader_mapping(shader_name, mat, mat_cache, prop_name, mapping_defs):
-    mapping_node = None
-    for mapping_def in mapping_defs:
-        if len(mapping_def) == 1:
-            texture_type = mapping_def[0]
-            mapping_node = nodeutils.get_tiling_node(mat, shader_name, texture_type)
-        elif mapping_node:
-            tiling_props = mapping_def[3:]
-            if prop_name in tiling_props:
-                socket_name = mapping_def[1]
-                nodeutils.set_node_input(mapping_node, socket_name, shaders.eval_tiling_param(mapping_def, mat_cache, 2))
-
-
-def update_object_modifier(obj, mat_cache, prop_name, mod_defs):
-    for mod_def in mod_defs:
-        if mod_def[0] == prop_name:
-            material_type = mod_def[1]
-            mod_type = mod_def[2]
-            mod_name = mod_def[3]
-            code = mod_def[4]
-
-            if mat_cache.material_type == material_type:
-                mod = modifiers.get_object_modifier(obj, mod_type, mod_name)
-                if mod:
-                    try:
-                        parameters = mat_cache.parameters
-                        exec(code, None, locals())
-                    except:
-                        utils.log_error("update_object_modifier(): unable to execute: " + code)
-
-
-def update_material_setting(mat, mat_cache, prop_name, setting_defs):
-    # mat is used in the exec code expression so keep it!
-    for setting_def in setting_defs:
-        if setting_def[0] == prop_name:
-            material_type = setting_def[1]
-            code = setting_def[2]
-
-            if mat_cache.material_type == material_type:
-                try:
-                    parameters = mat_cache.parameters
-                    exec(code, None, locals())
-                except:
-                    utils.log_error("update_material_setting(): unable to execute: " + code)
+
+def plan_material_setting(plan, mat, mat_cache, setting_def):
+    material_type = setting_def[1]
+    code = setting_def[2]
+
+    if mat_cache.material_type == material_type:
+        try:
+            path, evaluate = shaders.compile_assignment(code)
+            value = evaluate(None, mat, mat_cache.parameters)
+            plan.append(["SETTING", mat.name, path[1:], shaders.get_plan_value(value)])
+        except Exception as e:
+            utils.log_error("plan_material_setting(): unable to evaluate: " + code, e)
 
 
 def reset_parameters(context = bpy.context):
@@ -291,64 +372,189 @@ def reset_parameters(context = bpy.context):
 
         vars.block_property_update = False
 
-        update_all_properties(context)
+        # a reset must also put back node values edited by hand, so re-apply every parameter
+        update_all_properties(context, all_parameters = True)
 
     return
 
 
-def update_all_properties(context, update_mode = None):
-    if vars.block_property_update: return
+# the material parameter values last applied to the shader nodes:
+#   material pointer -> [snapshot signature, { prop name: value }]
+PARAMETER_SNAPSHOTS = {}
 
-    utils.start_timer()
 
-    props = bpy.context.scene.CC3ImportProps
-    chr_cache: CC3CharacterCache = props.get_context_character_cache(context)
+def get_parameter_value(parameters, prop_name):
+    value = getattr(parameters, prop_name, None)
+    if value is not None and not isinstance(value, str) and hasattr(value, "__len__"):
+        value = tuple(value)
+    return value
 
-    if chr_cache:
 
-        processed = []
+def get_parameter_snapshot_signature(bsdf_node, shader_node, shader_name):
+    """The snapshot is only valid for the same shader nodes and the same render target settings
+       used by the prop matrix conversion functions.
+    """
+    prefs = bpy.context.preferences.addons[__name__.partition(".")[0]].preferences
+    return (bsdf_node.as_pointer() if bsdf_node else 0,
+            shader_node.as_pointer() if shader_node else 0,
+            shader_name,
+            prefs.render_target,
+            prefs.cycles_sss_skin, prefs.cycles_sss_hair, prefs.cycles_sss_teeth,
+            prefs.cycles_sss_tongue, prefs.cycles_sss_eyes, prefs.cycles_sss_default)
 
-        for obj_cache in chr_cache.object_cache:
-            obj = obj_cache.object
-            if obj not in processed:
-                processed.append(obj)
-                if obj.type == "MESH":
-                    for mat in obj.data.materials:
-                        if mat and mat not in processed:
-                            processed.append(mat)
-                            mat_cache = chr_cache.get_material_cache(mat)
 
-                            if chr_cache.setup_mode == "BASIC":
+def store_parameter_snapshot(mat, mat_cache, shader_def, signature):
+    values = {}
+    for prop_name in shaders.get_all_prop_targets(shader_def).keys():
+        values[prop_name] = get_parameter_value(mat_cache.parameters, prop_name)
+    PARAMETER_SNAPSHOTS[mat.as_pointer()] = [signature, values]
 
-                                basic.update_basic_material(mat, mat_cache, "ALL")
 
-                            else:
+def invalidate_parameter_snapshot(mat):
+    if mat:
+        PARAMETER_SNAPSHOTS.pop(mat.as_pointer(), None)
+
+
+def update_parameter_snapshot(mat, mat_cache, prop_name):
+    snapshot = PARAMETER_SNAPSHOTS.get(mat.as_pointer())
+    if snapshot and prop_name in snapshot[1]:
+        snapshot[1][prop_name] = get_parameter_value(mat_cache.parameters, prop_name)
+
+
+def get_changed_parameters(mat, mat_cache, signature):
+    """Returns the parameters changed since they were last applied to the material,
+       or None if there is no valid snapshot and all the parameters must be applied.
+    """
+    snapshot = PARAMETER_SNAPSHOTS.get(mat.as_pointer())
+    if not snapshot or snapshot[0] != signature:
+        return None
+    changed = []
+    for prop_name, value in snapshot[1].items():
+        if get_parameter_value(mat_cache.parameters, prop_name) != value:
+            changed.append(prop_name)
+    return changed
+
+
+def plan_character_properties(chr_cache, plan, planned = None, all_parameters = False):
+    """Adds the updates of the character's material parameters to the update plan:
+       only the parameters changed since they were last applied, unless there is no valid snapshot
+       of the material or all_parameters is set.
+       The planned materials are added to the planned list as [mat, mat_cache, shader_def, snapshot signature].
+    """
+
+    processed = []
+    has_eyes = False
+
+    for obj_cache in chr_cache.object_cache:
+        obj = obj_cache.object
+        if obj not in processed:
+            processed.append(obj)
+            if obj.type == "MESH":
+                for mat in obj.data.materials:
+                    if mat and mat not in processed:
+                        processed.append(mat)
+                        mat_cache = chr_cache.get_material_cache(mat)
+                        if not mat_cache:
+                            continue
+
+                        shader_name = params.get_shader_lookup(mat_cache)
+                        bsdf_node, shader_node, mix_node = nodeutils.get_shader_nodes(mat, shader_name)
+                        shader_def = params.get_shader_def(shader_name)
+                        signature = get_parameter_snapshot_signature(bsdf_node, shader_node, shader_name)
+                        changed = None if all_parameters else get_changed_parameters(mat, mat_cache, signature)
+
+                        if changed is not None:
+
+                            # only the parameters that changed since the last update,
+                            # but always the modifier and material settings, which can be reset outside the parameters
+                            if shader_def and "modifiers" in shader_def.keys():
+                                for mod_def in shader_def["modifiers"]:
+                                    if mod_def[0] not in changed:
+                                        changed.append(mod_def[0])
+
+                            if shader_def and "settings" in shader_def.keys():
+                                for mat_def in shader_def["settings"]:
+                                    if mat_def[0] not in changed:
+                                        changed.append(mat_def[0])
+
+                            for prop_name in changed:
+                                plan_shader_property(plan, obj, mat, mat_cache, prop_name)
+
+                        else:
+
+                            shaders.plan_prop_matrix(plan, mat, bsdf_node, shader_node, mat_cache, shader_name)
+
+                            if shader_def and "textures" in shader_def.keys():
+                                for tex_def in shader_def["textures"]:
+                                    tiling_props = tex_def[5:]
+                                    for prop_name in tiling_props:
+                                        plan_shader_property(plan, obj, mat, mat_cache, prop_name)
 
-                                shader_name = params.get_shader_lookup(mat_cache)
-                                bsdf_node, shader_node, mix_node = nodeutils.get_shader_nodes(mat, shader_name)
-                                shader_def = params.get_shader_def(shader_name)
+                            if shader_def and "modifiers" in shader_def.keys():
+                                for mod_def in shader_def["modifiers"]:
+                                    prop_name = mod_def[0]
+                                    plan_shader_property(plan, obj, mat, mat_cache, prop_name)
 
-                                shaders.apply_prop_matrix(bsdf_node, shader_node, mat_cache, shader_name)
+                            if shader_def and "settings" in shader_def.keys():
+                                for mat_def in shader_def["settings"]:
+                                    prop_name = mat_def[0]
+                                    plan_shader_property(plan, obj, mat, mat_cache, prop_name)
 
-                                if "textures" in shader_def.keys():
-                                    for tex_def in shader_def["textures"]:
-                                        tiling_props = tex_def[5:]
-                                        for prop_name in tiling_props:
-                                            update_shader_property(obj, mat, mat_cache, prop_name)
+                        if shader_def and planned is not None:
+                            planned.append([mat, mat_cache, shader_def, signature])
 
-                                if "modifiers" in shader_def.keys():
-                                    for mod_def in shader_def["modifiers"]:
-                                        prop_name = mod_def[0]
-                                        update_shader_property(obj, mat, mat_cache, prop_name)
+                if obj_cache.is_eye():
+                    has_eyes = True
 
-                                if "settings" in shader_def.keys():
-                                    for mat_def in shader_def["settings"]:
-                                        prop_name = mat_def[0]
-                                        update_shader_property(obj, mat, mat_cache, prop_name)
+    return has_eyes
 
+
+def update_all_properties(context, update_mode = None, all_parameters = False):
+    if vars.block_property_update: return
+
+    utils.start_timer()
+
+    props = bpy.context.scene.CC3ImportProps
+    chr_cache: CC3CharacterCache = props.get_context_character_cache(context)
+
+    if chr_cache:
+
+        if chr_cache.setup_mode == "BASIC":
+
+            processed = []
+            for obj_cache in chr_cache.object_cache:
+                obj = obj_cache.object
+                if obj not in processed:
+                    processed.append(obj)
+                    if obj.type == "MESH":
+                        for mat in obj.data.materials:
+                            if mat and mat not in processed:
+                                processed.append(mat)
+                                mat_cache = chr_cache.get_material_cache(mat)
+                                basic.update_basic_material(mat, mat_cache, "ALL")
                     if obj_cache.is_eye():
                         meshutils.rebuild_eye_vertex_groups(chr_cache)
 
+        else:
+
+            # evaluate all the parameters first, then apply the socket writes in one pass
+            plan = []
+            planned = []
+            has_eyes = plan_character_properties(chr_cache, plan, planned, all_parameters)
+
+            nodeutils.reset_socket_write_stats()
+            shaders.apply_update_plan(plan)
+
+            for mat, mat_cache, shader_def, signature in planned:
+                store_parameter_snapshot(mat, mat_cache, shader_def, signature)
+
+            if has_eyes:
+                meshutils.rebuild_eye_vertex_groups(chr_cache)
+
+            writes, skipped = nodeutils.get_socket_write_stats()
+            utils.log_info(f"Update plan: {len(plan)} entries for {len(planned)} materials")
+            utils.log_info(f"Socket writes: {writes - skipped}, skipped (unchanged): {skipped}")
+
     utils.log_timer("update_all_properties()", "ms")
 
 
@@ -1008,6 +1214,39 @@ class CC3ObjectCache(bpy.types.PropertyGroup):
     def is_tearline(self):
         return self.object_type == "TEARLINE"
 
+# the material cache collections of the character cache, in material cache lookup order
+MATERIAL_CACHE_COLLECTIONS = ["eye_material_cache", "hair_material_cache", "head_material_cache", "skin_material_cache",
+                              "tongue_material_cache", "teeth_material_cache", "tearline_material_cache",
+                              "eye_occlusion_material_cache", "pbr_material_cache", "sss_material_cache"]
+# runtime index of the material caches:
+#   character cache pointer -> [signature, { material pointer: [collection name, index] }]
+MATERIAL_CACHE_INDEX = {}
+# runtime index of the import cache:
+#   [signature, { object pointer: character index }, { material pointer: character index },
+#    { object pointers not found since the last rebuild }, { material pointers not found since the last rebuild }]
+CHARACTER_INDEX = None
+
+
+def invalidate_character_index():
+    global CHARACTER_INDEX
+    CHARACTER_INDEX = None
+
+
+def clear_cache_indexes():
+    MATERIAL_CACHE_INDEX.clear()
+    PARAMETER_SNAPSHOTS.clear()
+    invalidate_character_index()
+    meshutils.clear_mesh_caches()
+    nodeutils.clear_node_id_index()
+
+
+@persistent
+def clear_cache_indexes_handler(dummy):
+    """Pointers to the cached data change on file load, undo and redo, so the runtime indexes must be rebuilt.
+    """
+    clear_cache_indexes()
+
+
 class CC3CharacterCache(bpy.types.PropertyGroup):
     open_mouth: bpy.props.FloatProperty(default=0.0, min=0, max=1, update=open_mouth_update)
     eye_close: bpy.props.FloatProperty(default=0.0, min=0, max=1, update=eye_close_update)
@@ -1138,46 +1377,11 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
            Note this will invalidate all current material cache references of the same type!
         """
         if mat:
-            for cache in self.tongue_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.tongue_material_cache, cache)
-                    return
-            for cache in self.teeth_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.teeth_material_cache, cache)
-                    return
-            for cache in self.head_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.head_material_cache, cache)
-                    return
-            for cache in self.skin_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.skin_material_cache, cache)
-                    return
-            for cache in self.tearline_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.tearline_material_cache, cache)
-                    return
-            for cache in self.eye_occlusion_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.eye_occlusion_material_cache, cache)
-                    return
-            for cache in self.eye_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.eye_material_cache, cache)
-                    return
-            for cache in self.hair_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.hair_material_cache, cache)
-                    return
-            for cache in self.pbr_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.pbr_material_cache, cache)
-                    return
-            for cache in self.sss_material_cache:
-                if cache.material == mat:
-                    utils.remove_from_collection(self.sss_material_cache, cache)
-                    return
+            cache = self.get_material_cache(mat)
+            if cache:
+                collection_name = self.get_material_cache_index()[mat.as_pointer()][0]
+                utils.remove_from_collection(getattr(self, collection_name), cache)
+                self.invalidate_material_cache_index()
 
     def get_object_cache(self, obj):
         """Returns the object cache for this object.
@@ -1197,6 +1401,7 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
             for cache in self.object_cache:
                 if cache.object == obj:
                     utils.remove_from_collection(self.object_cache, cache)
+                    invalidate_character_index()
                     return
 
     def has_objects(self, objects):
@@ -1228,6 +1433,7 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
             utils.log_info(f"Creating Object Cache for: {obj.name}")
             cache = self.object_cache.add()
             cache.object = obj
+            invalidate_character_index()
         return cache
 
 
@@ -1236,12 +1442,47 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
 
 
     def has_all_materials(self, materials):
+        index = self.get_material_cache_index()
         for mat in materials:
-            if mat and not self.has_material(mat):
+            if mat and (mat.as_pointer() not in index or not self.has_material(mat)):
                 return False
         return True
 
 
+    def get_material_cache_signature(self):
+        return (self.import_name, self.character_id,
+                tuple(len(getattr(self, name)) for name in MATERIAL_CACHE_COLLECTIONS))
+
+
+    def get_material_cache_index(self, rebuild = False):
+        """Returns the runtime index of material pointer -> [collection name, index] for this character.
+
+        The index is rebuilt when the collection sizes change, after file load, undo or redo,
+        or when invalidated by adding or removing a material cache.
+        """
+
+        key = self.as_pointer()
+        signature = self.get_material_cache_signature()
+        cached = MATERIAL_CACHE_INDEX.get(key)
+        if cached and cached[0] == signature and not rebuild:
+            return cached[1]
+
+        index = {}
+        for collection_name in MATERIAL_CACHE_COLLECTIONS:
+            collection = getattr(self, collection_name)
+            for i in range(0, len(collection)):
+                mat = collection[i].material
+                if mat is not None and mat.as_pointer() not in index:
+                    index[mat.as_pointer()] = [collection_name, i]
+        MATERIAL_CACHE_INDEX[key] = [signature, index]
+        return index
+
+
+    def invalidate_material_cache_index(self):
+        MATERIAL_CACHE_INDEX.pop(self.as_pointer(), None)
+        invalidate_character_index()
+
+
     def get_material_cache(self, mat):
         """Returns the material cache for this material.
 
@@ -1249,36 +1490,14 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
         """
 
         if mat is not None:
-            for cache in self.eye_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.hair_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.head_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.skin_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.tongue_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.teeth_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.tearline_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.eye_occlusion_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.pbr_material_cache:
-                if cache.material == mat:
-                    return cache
-            for cache in self.sss_material_cache:
-                if cache.material == mat:
-                    return cache
+            # a stale index entry triggers one rebuild of the index
+            for rebuild in [False, True]:
+                entry = self.get_material_cache_index(rebuild).get(mat.as_pointer())
+                if entry is None:
+                    return None
+                collection = getattr(self, entry[0])
+                if entry[1] < len(collection) and collection[entry[1]].material == mat:
+                    return collection[entry[1]]
         return None
 
 
@@ -1326,6 +1545,7 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
                 create_type = "DEFAULT"
             cache.material = mat
             cache.material_type = create_type
+            self.invalidate_material_cache_index()
         return cache
 
     def get_json_data(self):
@@ -1342,6 +1562,7 @@ class CC3CharacterCache(bpy.types.PropertyGroup):
         utils.log_info(f"Recasting material cache: {mat.name}")
         material_type = mat_cache.material_type
         mat_cache.material = None
+        self.invalidate_material_cache_index()
         new_mat_cache = self.add_material_cache(mat, material_type)
         if not chr_json:
             chr_json = self.get_character_json()
@@ -1450,25 +1671,81 @@ class CC3ImportProps(bpy.types.PropertyGroup):
     hair_toggle: bpy.props.BoolProperty(default=True)
     default_toggle: bpy.props.BoolProperty(default=True)
 
+    def get_character_index(self, rebuild = False):
+        """Returns the runtime index of object and material pointers -> character cache index in the import cache.
+
+        The signature only covers the import cache size, so the index is rebuilt when that changes, when it is
+        invalidated (by the character cache methods that add or remove object and material caches, and after
+        file load, undo, redo or import), and once on a lookup miss or stale entry. Any other change to
+        a character's object or material caches is picked up by that rebuild on a lookup miss.
+        """
+
+        global CHARACTER_INDEX
+        signature = (self.as_pointer(), len(self.import_cache))
+        if CHARACTER_INDEX and CHARACTER_INDEX[0] == signature and not rebuild:
+            return CHARACTER_INDEX
+
+        object_index = {}
+        material_index = {}
+        for i in range(0, len(self.import_cache)):
+            chr_cache = self.import_cache[i]
+            for obj_cache in chr_cache.object_cache:
+                if obj_cache.object and obj_cache.object.as_pointer() not in object_index:
+                    object_index[obj_cache.object.as_pointer()] = i
+            for mat_pointer in chr_cache.get_material_cache_index(rebuild):
+                if mat_pointer not in material_index:
+                    material_index[mat_pointer] = i
+        CHARACTER_INDEX = [signature, object_index, material_index, set(), set()]
+        return CHARACTER_INDEX
+
+    def find_character_cache(self, pointer, index_slot, get_cache):
+        """Looks up the pointer in the object (index_slot 1) or material (index_slot 2) character index
+           and returns (chr_cache, cache), where get_cache(chr_cache) returns the object or material cache.
+           A miss or a stale entry rebuilds the index and tries again, once per pointer until the next rebuild.
+        """
+
+        for rebuild in [False, True]:
+            index = self.get_character_index(rebuild)
+            i = index[index_slot].get(pointer)
+            if i is not None and i < len(self.import_cache):
+                chr_cache = self.import_cache[i]
+                cache = get_cache(chr_cache)
+                if cache:
+                    return chr_cache, cache
+            elif pointer in index[index_slot + 2]:
+                # already not found since the index was last rebuilt
+                break
+            if rebuild:
+                index[index_slot + 2].add(pointer)
+        return None, None
+
+    def get_character_cache_by_object(self, obj):
+        if obj:
+            return self.find_character_cache(obj.as_pointer(), 1, lambda chr_cache: chr_cache.get_object_cache(obj))
+        return None, None
+
+    def get_character_cache_by_material(self, mat):
+        if mat:
+            return self.find_character_cache(mat.as_pointer(), 2, lambda chr_cache: chr_cache.get_material_cache(mat))
+        return None, None
+
     def get_any_character_cache_from_objects(self, objects):
-        chr_cache : CC3CharacterCache
+        chr_caches = []
+        for obj in objects:
+            chr_cache = self.get_character_cache_by_object(obj)[0]
+            if chr_cache and chr_cache not in chr_caches:
+                chr_caches.append(chr_cache)
+        # in import cache order
         for chr_cache in self.import_cache:
-            if chr_cache.has_objects(objects):
+            if chr_cache in chr_caches and chr_cache.has_objects(objects):
                 return chr_cache
         return None
 
     def get_character_cache(self, obj, mat):
-        if obj:
-            for chr_cache in self.import_cache:
-                obj_cache = chr_cache.get_object_cache(obj)
-                if obj_cache:
-                    return chr_cache
-        if mat:
-            for chr_cache in self.import_cache:
-                mat_cache = chr_cache.get_material_cache(mat)
-                if mat_cache:
-                    return chr_cache
-        return None
+        chr_cache = self.get_character_cache_by_object(obj)[0]
+        if chr_cache is None:
+            chr_cache = self.get_character_cache_by_material(mat)[0]
+        return chr_cache
 
     def get_context_character_cache(self, context):
         obj = context.object
@@ -1485,17 +1762,7 @@ class CC3ImportProps(bpy.types.PropertyGroup):
         return chr_cache
 
     def get_object_cache(self, obj):
-        if obj:
-            for imp_cache in self.import_cache:
-                obj_cache = imp_cache.get_object_cache(obj)
-                if obj_cache:
-                    return obj_cache
-        return None
+        return self.get_character_cache_by_object(obj)[1]
 
     def get_material_cache(self, mat):
-        if mat:
-            for imp_cache in self.import_cache:
-                mat_cache = imp_cache.get_material_cache(mat)
-                if mat_cache:
-                    return mat_cache
-        return None
+        return self.get_character_cache_by_material(mat)[1]
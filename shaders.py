@@ -15,16 +15,201 @@
 # along with CC3_Blender_Tools.  If not, see <https://www.gnu.org/licenses/>.
 
 from platform import node
+import builtins
 import bpy
 import math
 
 from . import imageutils, jsonutils, materials, nodeutils, params, utils, vars
 
 
+# Compiled shader matrix expressions
+#
+# The shader matrix defs are compiled once into python callables (at register time) that use getattr/setattr
+# on the parameters group directly, rather than building and evaluating expression strings on every call.
+
+# (id(def), start index) -> [def, callable]
+COMPILED_DEFS = {}
+# (func, args) -> callable(parameters)
+COMPILED_EXPRESSIONS = {}
+# assignment code -> [target attribute path, callable(mod, mat, parameters)]
+COMPILED_ASSIGNMENTS = {}
+# id(shader def) -> [shader def, { prop_name: [[target type, def, texture type], ...] }]
+PROP_TARGETS = {}
+
+
+def get_param_func(func_name):
+    """Returns the parameter conversion function named in a shader matrix def.
+    """
+
+    func = globals().get(func_name)
+    if func is None:
+        func = getattr(builtins, func_name, None)
+    if not callable(func):
+        raise ValueError("Unknown function: " + str(func_name))
+    return func
+
+
+def compile_param_expression(func_name, args):
+    """Returns a callable(parameters) that evaluates the def function with the parameter values as arguments,
+       or just the parameter value if there is no function.
+    """
+
+    key = (func_name, tuple(args))
+    compiled = COMPILED_EXPRESSIONS.get(key)
+    if compiled is None:
+        args = list(args)
+        if func_name == "" or func_name == "=":
+            # expression is mat_cache parameter
+            prop_name = args[0]
+            compiled = lambda parameters: getattr(parameters, prop_name)
+        else:
+            func = get_param_func(func_name)
+            compiled = lambda parameters: func(*[getattr(parameters, arg) for arg in args])
+        COMPILED_EXPRESSIONS[key] = compiled
+    return compiled
+
+
+def get_compiled_def(param_def, start_index):
+    """Returns the compiled expression of a def: [..., func, arg, arg, ...] with the func at start_index.
+    """
+
+    key = (id(param_def), start_index)
+    entry = COMPILED_DEFS.get(key)
+    if entry and entry[0] is param_def:
+        return entry[1]
+    compiled = compile_param_expression(param_def[start_index], param_def[start_index + 1:])
+    # keep a reference to the def, so its id can't be reused
+    COMPILED_DEFS[key] = [param_def, compiled]
+    return compiled
+
+
+def compile_assignment(code):
+    """Compiles a modifier or material setting def assignment, e.g. "mod.strength = parameters.eye_iris_depth",
+       into the target attribute path, e.g. ["mod", "strength"], and a callable(mod, mat, parameters) for the value.
+    """
+
+    compiled = COMPILED_ASSIGNMENTS.get(code)
+    if compiled is None:
+        target, expression = code.split("=", 1)
+        path = target.strip().split(".")
+        if len(path) < 2 or path[0] not in ["mod", "mat"]:
+            raise ValueError("Invalid assignment: " + code)
+        evaluate = eval("lambda mod, mat, parameters: " + expression.strip(), globals())
+        compiled = [path, evaluate]
+        COMPILED_ASSIGNMENTS[code] = compiled
+    return compiled
+
+
+def set_attribute_path(item, path, value):
+    for attr in path[:-1]:
+        item = getattr(item, attr)
+    setattr(item, path[-1], value)
+
+
+def build_prop_targets(shader_def):
+    """Builds the index of parameter name -> the shader def entries (targets) the parameter drives,
+       in the order they are updated: inputs, bsdf, textures, mapping, modifiers, settings.
+    """
+
+    targets = {}
+
+    def add_target(prop_name, target_type, target_def, texture_type = None):
+        target = [target_type, target_def, texture_type]
+        prop_targets = targets.setdefault(prop_name, [])
+        if target not in prop_targets:
+            prop_targets.append(target)
+
+    for key, target_type in [["inputs", "INPUT"], ["bsdf", "BSDF"]]:
+        if key in shader_def.keys():
+            for input_def in shader_def[key]:
+                for prop_name in input_def[2:]:
+                    add_target(prop_name, target_type, input_def)
+
+    if "textures" in shader_def.keys():
+        for texture_def in shader_def["textures"]:
+            if len(texture_def) > 5:
+                for prop_name in texture_def[5:]:
+                    add_target(prop_name, "TILING", texture_def, texture_def[2])
+
+    if "mapping" in shader_def.keys():
+        texture_type = None
+        for mapping_def in shader_def["mapping"]:
+            if len(mapping_def) == 1:
+                texture_type = mapping_def[0]
+            elif texture_type:
+                for prop_name in mapping_def[3:]:
+                    add_target(prop_name, "MAPPING", mapping_def, texture_type)
+
+    if "modifiers" in shader_def.keys():
+        for mod_def in shader_def["modifiers"]:
+            add_target(mod_def[0], "MODIFIER", mod_def)
+
+    if "settings" in shader_def.keys():
+        for setting_def in shader_def["settings"]:
+            add_target(setting_def[0], "SETTING", setting_def)
+
+    PROP_TARGETS[id(shader_def)] = [shader_def, targets]
+    return targets
+
+
+def get_all_prop_targets(shader_def):
+    """Returns the index of parameter name -> targets for the shader def.
+    """
+
+    entry = PROP_TARGETS.get(id(shader_def))
+    if entry and entry[0] is shader_def:
+        return entry[1]
+    return build_prop_targets(shader_def)
+
+
+def get_prop_targets(shader_def, prop_name):
+    """Returns the [target type, def, texture type] targets in the shader def driven by the parameter.
+    """
+
+    return get_all_prop_targets(shader_def).get(prop_name, [])
+
+
+def compile_shader_matrix():
+    """Compiles all the shader matrix def expressions, reporting any errors now rather than on use.
+    """
+
+    errors = 0
+    for shader_def in params.SHADER_MATRIX:
+        build_prop_targets(shader_def)
+        compile_list = []
+        for key, start_index, min_length in [["inputs", 1, 3], ["bsdf", 1, 3], ["textures", 4, 6],
+                                             ["mapping", 2, 4], ["export", 2, 3]]:
+            if key in shader_def.keys():
+                for param_def in shader_def[key]:
+                    if len(param_def) >= min_length:
+                        compile_list.append([param_def, start_index])
+        if "vars" in shader_def.keys():
+            for var_def in shader_def["vars"]:
+                if var_def[2] not in ["", "=", "DEF"]:
+                    compile_list.append([[var_def[2]], -1])
+        for param_def, start_index in compile_list:
+            try:
+                if start_index == -1:
+                    get_param_func(param_def[0])
+                else:
+                    get_compiled_def(param_def, start_index)
+            except Exception as e:
+                utils.log_error("compile_shader_matrix(): error in def: " + str(param_def), e)
+                errors += 1
+        for key, code_index in [["modifiers", 4], ["settings", 2]]:
+            if key in shader_def.keys():
+                for code_def in shader_def[key]:
+                    try:
+                        compile_assignment(code_def[code_index])
+                    except Exception as e:
+                        utils.log_error("compile_shader_matrix(): error in def: " + str(code_def), e)
+                        errors += 1
+    return errors
+
+
 def get_prop_value(mat_cache, prop_name):
-    parameters = mat_cache.parameters
     try:
-        return eval("parameters." + prop_name, None, locals())
+        return getattr(mat_cache.parameters, prop_name)
     except:
         return None
 
@@ -38,133 +223,65 @@ def exec_var_param(var_def, mat_cache, mat_json):
         func = var_def[2]
         args = var_def[3:]
 
-        exec_expression = str(default_value)
+        value = default_value
 
         if mat_json:
 
             if func == "" or func == "=":
-                # expression is json var value
+                # value is json var value
                 json_value = jsonutils.get_material_json_var(mat_json, args[0])
                 if json_value is not None:
-                    exec_expression = str(json_value)
+                    value = json_value
 
             elif func != "DEF":
-                # construct eval function code
-                func_expression = func + "("
-                first = True
-                missing_args = False
-                for arg in args:
-                    if not first:
-                        func_expression += ", "
-                    first = False
-                    arg_value = jsonutils.get_material_json_var(mat_json, arg)
-                    if arg_value is None:
-                        missing_args = True
-                    func_expression += str(arg_value)
-                func_expression += ")"
-                if not missing_args:
-                    exec_expression = func_expression
-
-        exec_code = "parameters." + prop_name + " = " + exec_expression
-        exec(exec_code, None, locals())
-        utils.log_info("Applying: " + exec_code)
-    except:
-        utils.log_error("exec_var_param(): error in expression: " + exec_code)
-        utils.log_error(str(var_def))
+                # evaluate the function with the json var values
+                arg_values = [ jsonutils.get_material_json_var(mat_json, arg) for arg in args ]
+                if None not in arg_values:
+                    value = get_param_func(func)(*arg_values)
+
+        setattr(parameters, prop_name, value)
+        utils.log_info("Applying: parameters." + prop_name + " = " + str(value))
+    except Exception as e:
+        utils.log_error("exec_var_param(): error in def: " + str(var_def), e)
 
 
 def eval_input_param(input_def, mat_cache):
     try:
-        parameters = mat_cache.parameters
-
-        input_socket = input_def[0]
-        func = input_def[1]
-        args = input_def[2:]
-
-        if func == "" or func == "=":
-            # expression is mat_cache parameter
-            exec_expression = "parameters." + args[0]
-
-        else:
-            # construct eval function code
-            exec_expression = func + "("
-            first = True
-            for arg in args:
-                if not first:
-                    exec_expression += ", "
-                first = False
-                exec_expression += "parameters." + arg
-            exec_expression += ")"
-
-        return eval(exec_expression, None, locals())
-    except:
-        utils.log_error("eval_input_param(): error in expression: " + exec_expression)
+        return get_compiled_def(input_def, 1)(mat_cache.parameters)
+    except Exception as e:
+        utils.log_error("eval_input_param(): error in def: " + str(input_def), e)
         return None
 
 
 def eval_tiling_param(texture_def, mat_cache, start_index = 4):
     try:
-        parameters = mat_cache.parameters
-
-        func = texture_def[start_index]
-        args = texture_def[start_index + 1:]
-
-        if func == "" or func == "=":
-            # expression is mat_cache parameter
-            exec_expression = "parameters." + args[0]
-
-        else:
-            # construct eval function code
-            exec_expression = func + "("
-            first = True
-            for arg in args:
-                if not first:
-                    exec_expression += ", "
-                first = False
-                exec_expression += "parameters." + arg
-            exec_expression += ")"
-
-        return eval(exec_expression, None, locals())
-    except:
-        utils.log_error("eval_tiling_param(): error in expression: " + exec_expression)
+        return get_compiled_def(texture_def, start_index)(mat_cache.parameters)
+    except Exception as e:
+        utils.log_error("eval_tiling_param(): error in def: " + str(texture_def), e)
         return None
 
 
 def eval_parameters_func(parameters, func, args, default = None):
     try:
-        # construct eval function code
-        exec_expression = func + "("
-        first = True
-        for arg in args:
-            if not first:
-                exec_expression += ", "
-            first = False
-            exec_expression += "parameters." + arg
-        exec_expression += ")"
-
-        return eval(exec_expression, None, locals())
-    except:
-        utils.log_error("eval_parameters_func(): error in expression: " + exec_expression)
+        return compile_param_expression(func, args)(parameters)
+    except Exception as e:
+        utils.log_error("eval_parameters_func(): error in expression: " + func + str(list(args)), e)
         return default
 
 
 def eval_prop(prop_name, mat_cache):
     try:
-        parameters = mat_cache.parameters
-        exec_expression = "parameters." + prop_name
-        return eval(exec_expression, None, locals())
-    except:
-        utils.log_error("eval_prop(): error in expression: " + exec_expression)
+        return getattr(mat_cache.parameters, prop_name)
+    except Exception as e:
+        utils.log_error("eval_prop(): unable to get: parameters." + prop_name, e)
         return None
 
 
 def exec_prop(prop_name, mat_cache, value):
     try:
-        parameters = mat_cache.parameters
-        exec_expression = "parameters." + prop_name + " = " + str(value)
-        exec(exec_expression, None, locals())
-    except:
-        utils.log_error("exec_prop(): error in expression: " + exec_expression)
+        setattr(mat_cache.parameters, prop_name, value)
+    except Exception as e:
+        utils.log_error("exec_prop(): unable to set: parameters." + prop_name + " = " + str(value), e)
         return None
 
 
@@ -178,22 +295,100 @@ def fetch_prop_defaults(mat_cache, mat_json):
     vars.block_property_update = False
 
 
-def apply_prop_matrix(bsdf_node, group_node, mat_cache, shader_name):
+# Update plans:
+#
+#   A plan is a list of plain data entries (names and values only), so it can be built for a whole character
+#   (or many) first and then applied in one pass, and can be dumped to json for debugging:
+#
+#   ["INPUT", material name, node name, socket name, value]
+#   ["SETTING", material name, attribute path, value]
+#   ["MODIFIER", object name, modifier name, attribute path, value]
+#
+
+def get_plan_value(value):
+    """Converts an evaluated parameter value (e.g. a color property array) into plain data.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    try:
+        return [float(v) for v in value]
+    except:
+        return value
+
+
+def plan_node_input(plan, mat, node, socket, value):
+    if mat and node and value is not None:
+        plan.append(["INPUT", mat.name, node.name, socket, get_plan_value(value)])
+
+
+def plan_prop_matrix(plan, mat, bsdf_node, group_node, mat_cache, shader_name):
     matrix_group = params.get_shader_def(shader_name)
 
     if group_node and matrix_group and "inputs" in matrix_group.keys():
         for input_def in matrix_group["inputs"]:
             if input_def[0] in group_node.inputs:
-                prop_value = eval_input_param(input_def, mat_cache)
-                if prop_value is not None:
-                    nodeutils.set_node_input(group_node, input_def[0], prop_value)
+                plan_node_input(plan, mat, group_node, input_def[0], eval_input_param(input_def, mat_cache))
 
     if bsdf_node and matrix_group and "bsdf" in matrix_group.keys():
         for input_def in matrix_group["bsdf"]:
             if input_def[0] in bsdf_node.inputs:
-                prop_value = eval_input_param(input_def, mat_cache)
-                if prop_value is not None:
-                    nodeutils.set_node_input(bsdf_node, input_def[0], prop_value)
+                plan_node_input(plan, mat, bsdf_node, input_def[0], eval_input_param(input_def, mat_cache))
+
+    return plan
+
+
+def apply_update_plan(plan):
+    """Applies an update plan in one pass, grouped per material node tree and per object.
+    """
+
+    groups = {}
+    for entry in plan:
+        key = ("OBJECT" if entry[0] == "MODIFIER" else "MATERIAL", entry[1])
+        groups.setdefault(key, []).append(entry)
+
+    for (data_type, data_name), entries in groups.items():
+
+        if data_type == "MATERIAL":
+
+            mat = bpy.data.materials.get(data_name)
+            if not mat:
+                utils.log_warn("apply_update_plan(): material not found: " + data_name)
+                continue
+            nodes = mat.node_tree.nodes if mat.node_tree else None
+            node_lookup = {}
+
+            for entry in entries:
+                if entry[0] == "INPUT":
+                    node_name = entry[2]
+                    if node_name not in node_lookup:
+                        node_lookup[node_name] = nodes.get(node_name) if nodes else None
+                    nodeutils.set_node_input(node_lookup[node_name], entry[3], entry[4])
+                elif entry[0] == "SETTING":
+                    try:
+                        set_attribute_path(mat, entry[2], entry[3])
+                    except Exception as e:
+                        utils.log_error("apply_update_plan(): unable to set: " + data_name + "." + ".".join(entry[2]), e)
+
+        else:
+
+            obj = bpy.data.objects.get(data_name)
+            if not obj:
+                utils.log_warn("apply_update_plan(): object not found: " + data_name)
+                continue
+
+            for entry in entries:
+                mod = obj.modifiers.get(entry[2])
+                if mod:
+                    try:
+                        set_attribute_path(mod, entry[3], entry[4])
+                    except Exception as e:
+                        utils.log_error("apply_update_plan(): unable to set: " + entry[2] + "." + ".".join(entry[3]), e)
+
+
+def apply_prop_matrix(bsdf_node, group_node, mat_cache, shader_name):
+    mat = mat_cache.material if mat_cache else None
+    plan = plan_prop_matrix([], mat, bsdf_node, group_node, mat_cache, shader_name)
+    apply_update_plan(plan)
 
 
 def apply_basic_prop_matrix(node: bpy.types.Node, mat_cache, shader_name):
@@ -107,4 +107,6 @@ OCCLUSION_GROUP_ALL = "CC_EyeOcclusion_All"
 TEARLINE_GROUP_INNER = "CC_Tearline_Inner"
 TEARLINE_GROUP_ALL = "CC_Tearline_All"
 
-block_property_update = False
\ No newline at end of file
+block_property_update = False
+# apply shader property updates immediately, rather than coalescing them on a timer (for scripted use)
+immediate_property_update = False
\ No newline at end of file